@@ -2,10 +2,29 @@
 
 import sys
 import argparse
+import importlib
+import ujson
 
-from .app import runaggregate, runmatrix, runsequence, runzscore
-from .aggregate import bedaggregate
-from .sequence.twobit import TwoBitReader
+from .metrics.metrics import METRICS
+
+# module and function running each subcommand; a subcommand's module is only imported once it has been chosen, so that
+# each subcommand loads just the dependencies it uses
+COMMANDS = {
+    "aggregate": ("app", "runaggregate"),
+    "matrix": ("app", "runmatrix"),
+    "sequence": ("app", "runsequence"),
+    "zscore": ("app", "runzscore"),
+    "merge": ("app", "runmerge"),
+    "serve": ("server.server", "runserve")
+}
+
+def command(name):
+    """
+    Returns:
+        The function running the given subcommand, importing its module.
+    """
+    module, function = COMMANDS[name]
+    return getattr(importlib.import_module("." + module, __package__), function)
 
 def main():
     
@@ -14,7 +33,9 @@ def main():
     
     aggregate = subparsers.add_parser("aggregate", help = "aggregate signal across regions")
     aggregate.add_argument("--bed-file", type = str, help = "Path to the BED file with the regions to aggregate.", required = True)
-    aggregate.add_argument("--signal-file", type = str, help = "Path to a BigWig file with the signal to aggregate.", required = True)
+    aggregate.add_argument("--signal-file", type = str, nargs = "+", help = "Paths to one or more BigWig files with the signal to aggregate; every file is read using the same parsed regions and worker pool.")
+    aggregate.add_argument("--signal-manifest", type = str, help = "Path to a file listing further BigWig files, one per line, each optionally preceded by a track name and a tab.")
+    aggregate.add_argument("--stacked", action = "store_true", default = False, help = "if set, writes a single output holding every track; otherwise, with several tracks, writes one output per track, substituting the track name for {track} in --output-file or adding it before the extension")
     aggregate.add_argument("--output-file", type = str, help = "Path to write the output, in JSON format.", required = True)
     aggregate.add_argument("--extsize", type = int, help = "number of basepairs to expand each region; default 500.", default = 500)
     aggregate.add_argument("--start-index", type = int, help = "Index of the first element to aggregate (inclusive); default 1.", default = 0)
@@ -23,22 +44,39 @@ def main():
     aggregate.add_argument("-j", type = int, help = "number of cores to use in parallel; default 8.", default = 8)
     aggregate.add_argument("--decimal-resolution", type = int, help = "Number of decimal places to keep in output.", default = 2)
     aggregate.add_argument("--grouped", action = "store_true", help = "If specified, groups output by the name field of each BED line.", default = False)
-    aggregate.set_defaults(func = runaggregate)
+    aggregate.add_argument("--shared-memory", action = "store_true", default = False, help = "if set, parallel jobs write signal into a single shared memory-mapped matrix")
+    aggregate.add_argument("--streaming", action = "store_true", default = False, help = "if set, regions are read and aggregated in batches, using constant memory")
+    aggregate.add_argument("--shard", action = "store_true", default = False, help = "if set, writes partial sums for the lines from --start-index to --end-index of the BED file, which the merge subcommand combines with other shards")
+    aggregate.add_argument("--cache-dir", type = str, default = None, help = "if passed, directory in which to cache extracted basepair signal, which is reused by later runs on the same BigWig, regions and extsize")
+    aggregate.add_argument("--cache-max-size", type = int, default = 10240, help = "megabytes of signal to keep in --cache-dir before evicting the least recently used entries; default 10240.")
+    aggregate.add_argument("--summary", type = str, choices = [ "bases", "exact", "approximate", "intervals" ], default = "bases", help = "how bins are computed: bases reads every basepair and sums them; when --resolution is above 1, exact has the BigWig library sum each bin from its base-level data, and approximate sums each bin from the BigWig's precomputed zoom levels, which is fastest for large bins but approximate; intervals builds bins from the BigWig's stored intervals, so work scales with covered basepairs, which suits sparse tracks. default bases.")
+    aggregate.set_defaults(command = "aggregate")
     
     matrix = subparsers.add_parser("matrix", help = "produce a signal matrix for the given regions")
     matrix.add_argument("--bed-file", type = str, help = "Path to the BED file with the regions to aggregate.", required = True)
-    matrix.add_argument("--signal-file", type = str, help = "Path to a BigWig file with the signal to aggregate.", required = True)
+    matrix.add_argument("--signal-file", type = str, nargs = "+", help = "Paths to one or more BigWig files with the signal to extract; every file is read using the same parsed regions and worker pool.")
+    matrix.add_argument("--signal-manifest", type = str, help = "Path to a file listing further BigWig files, one per line, each optionally preceded by a track name and a tab.")
+    matrix.add_argument("--stacked", action = "store_true", default = False, help = "if set, writes a single output holding every track; otherwise, with several tracks, writes one output per track, substituting the track name for {track} in --output-file or adding it before the extension")
     matrix.add_argument("--output-file", type = str, help = "Path to write the output, in JSON format.", required = True)
     matrix.add_argument("--extsize", type = int, help = "number of basepairs to expand each region; default 500.", default = 500)
     matrix.add_argument("--start-index", type = int, help = "Index of the first element to aggregate (inclusive); default 1.", default = 0)
     matrix.add_argument("--end-index", type = int, help = "Index of the last element to aggregate (not inclusive); defaults to the end of the list.", default = None)
     matrix.add_argument("--resolution", type = int, help = "Bin size to use in basepairs; defaults to 1 (a single basepair)", default = 1)
     matrix.add_argument("-j", type = int, help = "number of cores to use in parallel; default 8.", default = 8)
-    matrix.add_argument("--decimal-resolution", type = int, help = "Number of decimal places to keep in output.", default = 2)
+    matrix.add_argument("--decimal-resolution", type = int, help = "Has no effect: binned matrix values are always rounded to 2 decimal places. Kept for compatibility.", default = 2)
     matrix.add_argument("--coordinate-map", action = "store_true", default = False, help = "if set, output JSON maps coordinates to values")
     matrix.add_argument("--streaming", action = "store_true", default = False, help = "if set, batches of results are streamed to an output file rather than kept in memory")
+    matrix.add_argument("--resume", action = "store_true", default = False, help = "if set, streams output while recording progress in a checkpoint file next to --output-file; rerunning the same command with --resume after an interruption continues from the last completed batch")
     matrix.add_argument("--random-access", action = "store_true", default = False, help = "if set, writes output in a format designed for seeking and requesting by index")
-    matrix.set_defaults(func = runmatrix)
+    matrix.add_argument("--shared-memory", action = "store_true", default = False, help = "if set, parallel jobs write signal into a single shared memory-mapped matrix")
+    matrix.add_argument("--format", type = str, choices = [ "json", "binary" ], default = "json", help = "output format; binary writes a seekable matrix file in a single pass. default json.")
+    matrix.add_argument("--dtype", type = str, choices = [ "float32", "float16" ], default = "float32", help = "value type for binary output; default float32. Shards are always written as float64.")
+    matrix.add_argument("--inflight-batches", type = int, default = 2, help = "with --streaming, number of extracted batches which may wait to be written while the next is read; 0 disables pipelining. default 2.")
+    matrix.add_argument("--shard", action = "store_true", default = False, help = "if set, writes a binary matrix file for the lines from --start-index to --end-index of the BED file, which the merge subcommand combines with other shards")
+    matrix.add_argument("--cache-dir", type = str, default = None, help = "if passed, directory in which to cache extracted basepair signal, which is reused by later runs on the same BigWig, regions and extsize")
+    matrix.add_argument("--cache-max-size", type = int, default = 10240, help = "megabytes of signal to keep in --cache-dir before evicting the least recently used entries; default 10240.")
+    matrix.add_argument("--summary", type = str, choices = [ "bases", "exact", "approximate", "intervals" ], default = "bases", help = "how bins are computed: bases reads every basepair and sums them; when --resolution is above 1, exact has the BigWig library sum each bin from its base-level data, and approximate sums each bin from the BigWig's precomputed zoom levels, which is fastest for large bins but approximate; intervals builds bins from the BigWig's stored intervals, so work scales with covered basepairs, which suits sparse tracks. default bases.")
+    matrix.set_defaults(command = "matrix")
 
     sequence = subparsers.add_parser("sequence", help = "extract one hot encoded sequence for the given regions from a 2bit file")
     sequence.add_argument("--bed-file", type = str, help = "Path to the BED file with the regions for which to extract sequence.", required = True)
@@ -48,8 +86,12 @@ def main():
     sequence.add_argument("-j", type = int, help = "number of cores to use in parallel; default 8.", default = 8)
     sequence.add_argument("--coordinate-map", action = "store_true", default = False, help = "if set, output JSON maps coordinates to values")
     sequence.add_argument("--streaming", action = "store_true", default = False, help = "if set, batches of results are streamed to an output file rather than kept in memory")
+    sequence.add_argument("--resume", action = "store_true", default = False, help = "if set, streams output while recording progress in a checkpoint file next to --output-file; rerunning the same command with --resume after an interruption continues from the last completed batch")
     sequence.add_argument("--random-access", action = "store_true", default = False, help = "if set, writes output in a format designed for seeking and requesting by index")
-    sequence.set_defaults(func = runsequence)
+    sequence.add_argument("--format", type = str, choices = [ "json", "binary" ], default = "json", help = "output format; binary writes a seekable uint8 array file in a single pass. default json.")
+    sequence.add_argument("--encoding", type = str, choices = [ "onehot", "codes" ], default = "onehot", help = "binary encoding: one hot (L x 4) or base codes 0-3 with 4 for N (L); default onehot.")
+    sequence.add_argument("--cache-size", type = int, default = 0, help = "megabytes of decoded chromosome sequence to cache in each process; default 0 (no cache).")
+    sequence.set_defaults(command = "sequence")
 
     zscore = subparsers.add_parser("zscore", help = "computes Z-scores for aggregated signal across a list of regions")
     zscore.add_argument("--bed-file", type = str, help = "Path to the BED file with the regions to aggregate.", required = True)
@@ -59,11 +101,43 @@ def main():
     zscore.add_argument("--end-index", type = int, help = "Index of the last element to aggregate (not inclusive); defaults to the end of the list.", default = None)
     zscore.add_argument("--extsize", type = int, help = "if passed, extends each region by the given number of basepairs in each direction around the center points.", default = None)
     zscore.add_argument("--json", action = "store_true", default = False, help = "if set, writes output as a JSON array")
+    zscore.add_argument("--stat", type = str, choices = [ "sum", "mean", "max", "coverage" ], default = "sum", help = "summary statistic of the signal in each region to score; default sum.")
+    zscore.add_argument("--approximate", action = "store_true", default = False, help = "if set, statistics are approximated from the BigWig's zoom levels rather than computed from base-level data")
+    zscore.add_argument("--intervals", action = "store_true", default = False, help = "if set, statistics are computed from the BigWig's stored intervals, reading nearby regions together; suits sparse tracks")
     zscore.add_argument("-j", type = int, help = "number of cores to use in parallel; default 8.", default = 8)
-    zscore.set_defaults(func = runzscore)
+    zscore.set_defaults(command = "zscore")
+
+    merge = subparsers.add_parser("merge", help = "combines the outputs of aggregate --shard or matrix --shard into a single output")
+    merge.add_argument("shards", type = str, nargs = "+", help = "Paths to the shard outputs, in the order of the BED lines they cover.")
+    merge.add_argument("--output-file", type = str, help = "Path to write the output.", required = True)
+    merge.add_argument("--coordinate-map", action = "store_true", default = False, help = "for matrix shards, if set, output JSON maps coordinates to values")
+    merge.add_argument("--random-access", action = "store_true", default = False, help = "for matrix shards, if set, writes output in a format designed for seeking and requesting by index")
+    merge.add_argument("--format", type = str, choices = [ "json", "binary" ], default = "json", help = "output format for matrix shards; default json.")
+    merge.add_argument("--dtype", type = str, choices = [ "float32", "float16" ], default = "float32", help = "value type for binary output; default float32. Shards are always written as float64.")
+    merge.set_defaults(command = "merge")
+
+    serve = subparsers.add_parser("serve", help = "answers aggregate, matrix, sequence and zscore requests from a long-running process")
+    serve.add_argument("--socket", type = str, help = "Path of a Unix socket to serve requests on.", default = None)
+    serve.add_argument("--host", type = str, help = "host to serve requests on if --port is given; default 127.0.0.1.", default = "127.0.0.1")
+    serve.add_argument("--port", type = int, help = "TCP port to serve requests on, if --socket is not given.", default = None)
+    serve.add_argument("--batch-window", type = float, default = 5, help = "milliseconds to wait for other requests reading the same file, which are then extracted as one batch; default 5.")
+    serve.add_argument("--max-batch-regions", type = int, default = 10000, help = "largest number of regions to gather into one batch, which also sets the longest request accepted (256 bytes per region); default 10000.")
+    serve.add_argument("--max-open-files", type = int, default = 64, help = "largest number of BigWig and 2bit files to keep open, closing the least recently used; default 64.")
+    serve.set_defaults(command = "serve")
+
+    for subparser in (aggregate, matrix, sequence, zscore, merge, serve):
+        subparser.add_argument("--profile", action = "store_true", default = False, help = "if set, prints progress and a breakdown of time spent in each stage to stderr")
+        subparser.add_argument("--metrics-file", type = str, default = None, help = "if passed, path to write per-stage timings, counters and worker utilization to, in JSON format")
 
     args = parser.parse_args()
-    args.func(args)
+    if args.profile or args.metrics_file is not None: METRICS.enable(progress = args.profile)
+    try:
+        command(args.command)(args)
+    finally:
+        if args.profile: print(METRICS.summary(), file = sys.stderr)
+        if args.metrics_file is not None:
+            with open(args.metrics_file, 'w') as o:
+                o.write(ujson.dumps(METRICS.report(), indent = 2) + '\n')
 
     return 0
 
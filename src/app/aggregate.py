@@ -3,84 +3,545 @@
 import os
 import numpy
 import pyBigWig
-import math
-import gzip
+import tempfile
 
-from joblib import Parallel, delayed
+from joblib import Parallel
+
+from .bed.bed import BedReader, loadbed
+from .batch.schedule import sortorder, divide, spans
+from .metrics.metrics import METRICS
+from .matrixfile.matrixfile import BIN_DECIMALS
+
+BIGWIGS = {}
+
+def openbigwig(bigwig):
+    """
+    Returns an open handle on the given BigWig which is shared by every caller in this process, so that long-lived worker
+    processes open each file only once.
+    """
+    if bigwig not in BIGWIGS:
+        bw = pyBigWig.open(bigwig)
+        if bw is None:
+            raise Exception("Error opening %s: no such file or directory." % bigwig)
+        BIGWIGS[bigwig] = bw
+    return BIGWIGS[bigwig]
 
 def bwvalue(region, bw):
     t = tuple(region[:3])
     try:
-        return ( bw.values(*t) if region[3] != '-' else list(reversed(bw.values(*t))) )
+        values = bw.values(*t, numpy = True)
+        return values if region[3] != '-' else values[::-1]
     except:
-        return []
+        return numpy.zeros(0, dtype = numpy.float32)
 
-def read(regions, divpoints, bigwig, i):
+def read(regions, rows, bigwig, width = None, out = None):
     """
-    Reads signal for a given set of regions from a BigWig. Intended to be called in Parallel; data are read only
-    for the subset of regions specified by the given index. For each region, if a strand is present and the region
-    is on the minus strand, the order of the signal values is reversed for aggregation purposes.
+    Reads signal for a given set of regions from a BigWig. Intended to be called in Parallel on one job's share of the
+    regions, in genomic order; overlapping or adjacent regions are read from the BigWig with a single request. For each
+    region, if a strand is present and the region is on the minus strand, the order of the signal values is reversed
+    for aggregation purposes.
 
     Args:
-        regions (list): complete list of regions to read, each as a tuple of chromosome, start, end, strand or None
-        divpoints (list): list of offsets in the region list at which each individual job should start
+        regions (list): regions to read, each as a tuple of chromosome, start, end, strand, sorted by position
+        rows (numpy.ndarray): index of each region in the complete result
         bigwig (string): path to the BigWig file to read
-        i (int): index in the divpoints list which this job should handle
+        width (int): number of values in each region; if None, regions may differ in size
+        out (numpy.ndarray): if passed along with width, a matrix covering the complete region list (typically a memory
+            mapped array shared with the parent process) into which the rows for this job are written in place
+
+    Returns:
+        A tuple of the rows parameter and the signal for each region: if width is given, a float32 matrix with one row per
+        region, where regions which cannot be read are rows of zeroes; otherwise, a list of float32 vectors, where regions
+        which cannot be read are empty vectors. Missing values within a region are replaced with zeroes. If out is passed,
+        the rows are written to it and None is returned.
+    """
+    bw = openbigwig(bigwig)
+    values = [ None for _ in regions ]
+    for chrom, start, end, members in spans(regions):
+        try:
+            span = bw.values(chrom, start, end, numpy = True)
+        except:
+            span = None
+        for k in members:
+            if span is None:
+                values[k] = bwvalue(regions[k], bw)
+                continue
+            values[k] = span[regions[k][1] - start : regions[k][2] - start]
+            if regions[k][3] == '-': values[k] = values[k][::-1]
+    if width is None:
+        return rows, [ numpy.nan_to_num(x) for x in values ]
+    matrix = numpy.zeros((len(regions), width), dtype = numpy.float32)
+    for k, x in enumerate(values):
+        matrix[k, :len(x)] = x
+    numpy.nan_to_num(matrix, copy = False)
+    if out is None: return rows, matrix
+    out[rows] = matrix
+
+def extend(bigwig, centers, extsize):
+    """
+    Converts center points to regions extending the given number of basepairs in both directions.
+
+    Args:
+        bigwig (string): path to the BigWig the regions will be read from, used to check chromosome bounds
+        centers (list): list of regions, each as a tuple of chromosome, center position, strand
+        extsize (int): number of basepairs to extend each center point
 
     Returns:
-        A list of value vectors, one per region beginning at index divpoints[i] in the regions list and ending
-        at index divpoints[i + 1] - 1, inclusive. Regions which are None are assumed to be missing and return an
-        empty vector.
+        A list of regions, each as a tuple of chromosome, start, end, strand, or None if the region is out of range
+        for the BigWig.
     """
-    bw = pyBigWig.open(bigwig)
-    if bw is None:
-        raise Exception("Error opening %s: no such file or directory." % bigwig)
-    values = [
-        bwvalue(region, bw) if region is not None else []
-        for region in regions[divpoints[i]:divpoints[i + 1]]
+    bw = openbigwig(bigwig)
+    return [
+        (chrom, x - extsize, x + extsize, strand) if x >= extsize and bw.chroms(chrom) is not None and x + extsize < bw.chroms(chrom) else None
+        for chrom, x, strand in centers
     ]
-    return [ [ x if not numpy.isnan(x) else 0 for x in xx ] for xx in values ]
 
-def valuematrix(bigwig, centers, extsize, j = 8, noextension = False):
+def valuematrix(bigwig, centers, extsize, j = 8, noextension = False, shared_memory = False, parallel = None, cache = None):
     """
     Reads signal for a given set of regions from a BigWig in parallel. Each region is uniformly sized around the
     centers points passed in the "centers" parameter. For each region, if a strand is present and the region is on
-    the minus strand, the order of the signal values is reversed for aggregation purposes.
+    the minus strand, the order of the signal values is reversed for aggregation purposes. Regions are read in genomic
+    order regardless of input order, with each job assigned a contiguous stretch of the genome containing a roughly equal
+    number of basepairs, so that BigWig data blocks are decompressed as few times as possible.
 
     Args:
         bigwig (string): path to the BigWig to read
         centers (list): list of regions, each as a tuple of chromosome, center position, strand
         extsize (int): number of basepairs to read around the center point
         j (int): number of threads to use; default is 8
+        noextension (boolean): if set, centers are complete regions, as tuples of chromosome, start, end, strand, which are read as-is
+        shared_memory (boolean): if set, the result matrix is allocated once as a memory-mapped file which each job fills in
+            place, rather than each job returning its rows to be copied into the result; ignored if noextension is set
+        parallel (joblib.Parallel): if passed, an existing worker pool to run the reads on, rather than a new pool of j workers
+        cache (cache.MatrixCache): if passed, the matrix is returned from this cache if present, and added to it if not;
+            ignored if noextension is set
 
     Returns:
-        A matrix of signal values for each region; the rows are the regions in their original order, and each column
-        represents a single basepair. Regions which are out of range for the given bigWig are represented by empty vectors.
+        A float32 matrix of signal values for each region; the rows are the regions in their original order, and each
+        column represents a single basepair. Regions which are out of range for the given bigWig are represented by rows
+        of zeroes. If noextension is set, regions may differ in size and a list of float32 vectors is returned instead, with
+        out of range regions represented by empty vectors.
+    """
+    regions = centers if noextension else extend(bigwig, centers, extsize)
+    width = None if noextension else extsize * 2
+    order = sortorder(regions)
+    divpoints = divide(regions, order, j)
+    jobs = [ order[divpoints[i]:divpoints[i + 1]] for i in range(len(divpoints) - 1) ]
+    if cache is not None and not noextension:
+        with METRICS.stage("cache"):
+            key = cache.key(bigwig, regions, width)
+            matrix = cache.get(key)
+        if matrix is not None:
+            METRICS.count("regions_cached", len(regions))
+            return matrix
+    if parallel is None: parallel = Parallel(n_jobs = j)
+    if shared_memory and not noextension and len(regions) > 0:
+        with tempfile.TemporaryDirectory() as d:
+            matrix = numpy.memmap(os.path.join(d, "matrix"), dtype = numpy.float32, mode = "w+", shape = (len(regions), width))
+            METRICS.jobs(parallel, "read", read, [ ([ regions[i] for i in rows ], rows, bigwig, width, matrix) for rows in jobs ])
+            if cache is not None:
+                with METRICS.stage("cache"): cache.put(key, matrix)
+        METRICS.count("regions_extracted", len(regions))
+        return matrix
+    readregions = METRICS.jobs(parallel, "read", read, [ ([ regions[i] for i in rows ], rows, bigwig, width) for rows in jobs ])
+    METRICS.count("regions_extracted", len(regions))
+    if noextension:
+        retval = [ numpy.zeros(0, dtype = numpy.float32) for _ in regions ]
+        for rows, readregionset in readregions:
+            for i, x in zip(rows, readregionset):
+                retval[i] = x
+        return retval
+    matrix = numpy.zeros((len(regions), width), dtype = numpy.float32)
+    for rows, readregionset in readregions:
+        matrix[rows] = readregionset
+    if cache is not None:
+        with METRICS.stage("cache"): cache.put(key, matrix)
+    return matrix
+
+def binsums(regions, rows, bigwig, width, resolution, exact = True):
+    """
+    Sums signal in bins across each of a set of equally sized regions with pyBigWig's stats, so that each bin is summarized
+    by the BigWig library rather than by reading its individual values. Bins line up with those from condensing the
+    region's signal: on the minus strand the bins are reversed and, if the width is not a multiple of the resolution, the
+    leftover basepairs are dropped from the start of the region rather than its end. Intended to be called in Parallel on
+    one job's share of the regions.
+
+    Args:
+        regions (list): regions to read, each as a tuple of chromosome, start, end, strand or None, sorted by position
+        rows (numpy.ndarray): index of each region in the complete result
+        bigwig (string): path to the BigWig file to read
+        width (int): number of basepairs in each region
+        resolution (int): bin size in basepairs
+        exact (boolean): if set, bins are summed from base-level data; otherwise they are approximated from the BigWig's
+            precomputed zoom level summaries
+
+    Returns:
+        A tuple of the rows parameter and a float64 matrix of bin sums with one row per region. Regions which cannot be read
+        are rows of zeroes, and bins with no signal are zero.
+    """
+    bw = openbigwig(bigwig)
+    bins = width // resolution
+    matrix = numpy.zeros((len(regions), bins), dtype = numpy.float64)
+    for k, region in enumerate(regions):
+        if region is None or bins == 0: continue
+        chrom, start, end, strand = region
+        start = end - bins * resolution if strand == '-' else start
+        try:
+            values = bw.stats(chrom, start, start + bins * resolution, type = "sum", nBins = bins, exact = exact)
+        except:
+            continue
+        matrix[k] = [ x if x is not None else 0 for x in values ]
+        if strand == '-': matrix[k] = matrix[k][::-1]
+    return rows, matrix
+
+def segments(bw, chrom, start, end):
+    """
+    Returns:
+        Tuple of float64 vectors with the start, end and value of each interval stored in a BigWig between the given
+        positions, clipped to them, or None if there are none or the chromosome cannot be read.
+    """
+    try:
+        intervals = bw.intervals(chrom, start, end)
+    except:
+        intervals = None
+    if not intervals: return None
+    intervals = numpy.array(intervals, dtype = numpy.float64)
+    return numpy.maximum(intervals[:, 0], start), numpy.minimum(intervals[:, 1], end), intervals[:, 2]
+
+def integrate(starts, ends, values, positions):
+    """
+    Integrates a step function given as sorted, non-overlapping intervals, as from segments.
+
+    Returns:
+        An array with the same shape as positions holding the sum of the values of every basepair before each position.
+    """
+    cumulative = numpy.concatenate([ [ 0 ], numpy.cumsum(values * (ends - starts)) ])
+    i = numpy.searchsorted(ends, positions, side = "right")
+    partial = numpy.append(values, 0)[i] * numpy.clip(positions - numpy.append(starts, numpy.inf)[i], 0, None)
+    return cumulative[i] + partial
+
+def readintervals(regions, rows, bigwig, width, resolution = 1):
+    """
+    Reads signal for a set of equally sized regions from the intervals stored in a BigWig, rather than from its basepair
+    values, so that the work done scales with the number of covered stretches in the BigWig instead of the size of the
+    regions; this suits sparse tracks, which are mostly zero. Overlapping or adjacent regions are read with a single
+    request, as in read. Intended to be called in Parallel on one job's share of the regions.
+
+    Args:
+        regions (list): regions to read, each as a tuple of chromosome, start, end, strand, sorted by position
+        rows (numpy.ndarray): index of each region in the complete result
+        bigwig (string): path to the BigWig file to read
+        width (int): number of basepairs in each region
+        resolution (int): bin size in basepairs; if above 1, each bin is summed directly from the intervals overlapping it
+
+    Returns:
+        A tuple of the rows parameter and the signal for each region: if resolution is 1, a float32 matrix of basepair values
+        as from read; otherwise a float64 matrix of bin sums, with bins lined up as in binsums. Regions which cannot be read
+        are rows of zeroes.
+    """
+    bw = openbigwig(bigwig)
+    bins = width // resolution
+    matrix = numpy.zeros((len(regions), bins), dtype = numpy.float32 if resolution == 1 else numpy.float64)
+    for chrom, start, end, members in spans(regions):
+        covered = segments(bw, chrom, start, end)
+        if covered is None or bins == 0: continue
+        starts, ends, values = covered
+        if resolution == 1:
+            lengths = (ends - starts).astype(numpy.int64)
+            offsets = numpy.repeat(starts.astype(numpy.int64) - start - numpy.cumsum(lengths) + lengths, lengths)
+            span = numpy.zeros(end - start, dtype = numpy.float32)
+            span[offsets + numpy.arange(len(offsets))] = numpy.repeat(values, lengths)
+            for k in members:
+                row = span[regions[k][1] - start : regions[k][2] - start]
+                matrix[k, :len(row)] = row if regions[k][3] != '-' else row[::-1]
+            continue
+        minus = numpy.array([ regions[k][3] == '-' for k in members ])
+        first = numpy.array([ regions[k][2] - bins * resolution if regions[k][3] == '-' else regions[k][1] for k in members ])
+        sums = numpy.diff(integrate(starts, ends, values, first[:, None] + resolution * numpy.arange(bins + 1)), axis = 1)
+        sums[minus] = sums[minus, ::-1]
+        matrix[members] = sums
+    return rows, matrix
+
+def intervalstats(regions, rows, bigwig, stat = "sum"):
+    """
+    Computes a summary statistic of the signal in each of a set of regions from the intervals stored in a BigWig, as
+    summarize does with exact statistics, but reading overlapping or adjacent regions with a single request and without
+    a call into the BigWig library per region. Intended to be called in Parallel on one job's share of the regions.
+
+    Args:
+        regions (list): regions to summarize, each as a tuple of chromosome, start, end, strand, sorted by position
+        rows (numpy.ndarray): index of each region in the complete result
+        bigwig (string): path to the BigWig file to read
+        stat (string): statistic to compute: sum, mean, max or coverage (the fraction of basepairs with signal)
+
+    Returns:
+        A tuple of the rows parameter and a float64 vector with the statistic for each region. Regions which cannot be
+        read or which have no signal are zero.
+    """
+    bw = openbigwig(bigwig)
+    values = numpy.zeros(len(regions), dtype = numpy.float64)
+    for chrom, start, end, members in spans(regions):
+        covered = segments(bw, chrom, start, end)
+        if covered is None: continue
+        starts, ends, signal = covered
+        bounds = numpy.array([ regions[k][1:3] for k in members ], dtype = numpy.float64)
+        total = numpy.diff(integrate(starts, ends, signal, bounds), axis = 1)[:, 0]
+        bases = numpy.diff(integrate(starts, ends, numpy.ones(len(signal)), bounds), axis = 1)[:, 0]
+        if stat == "sum":
+            values[members] = total
+        elif stat == "mean":
+            values[members] = numpy.divide(total, bases, out = numpy.zeros(len(members)), where = bases > 0)
+        elif stat == "coverage":
+            values[members] = bases / numpy.maximum(bounds[:, 1] - bounds[:, 0], 1)
+        else:
+            first = numpy.searchsorted(ends, bounds[:, 0], side = "right")
+            last = numpy.searchsorted(starts, bounds[:, 1], side = "left")
+            values[members] = [ signal[i:l].max() if l > i else 0 for i, l in zip(first, last) ]
+    return rows, values
+
+def binmatrix(bigwig, centers, extsize, j = 8, resolution = 1, summary = "exact", parallel = None):
+    """
+    Bins signal around each of a set of center points in parallel without condensing basepair values, using binsums or,
+    if summary is intervals, readintervals. Bin sums are rounded to BIN_DECIMALS decimal places, as by condense.
+
+    Args:
+        bigwig (string): path to the BigWig to read
+        centers (list): list of regions, each as a tuple of chromosome, center position, strand
+        extsize (int): number of basepairs to read around the center point
+        j (int): number of threads to use; default is 8
+        resolution (int): bin size in basepairs
+        summary (string): exact or approximate, to sum bins with binsums from base-level data or zoom level summaries;
+            or intervals, to build bins from the BigWig's intervals with readintervals
+        parallel (joblib.Parallel): if passed, an existing worker pool to run the reads on, rather than a new pool of j workers
+
+    Returns:
+        A matrix with one row per region, in their original order: float64 bin sums, or float32 basepair values if
+        resolution is 1. Regions which are out of range for the BigWig are rows of zeroes.
+    """
+    regions = extend(bigwig, centers, extsize)
+    order = sortorder(regions)
+    divpoints = divide(regions, order, j)
+    jobs = [ order[divpoints[i]:divpoints[i + 1]] for i in range(len(divpoints) - 1) ]
+    if parallel is None: parallel = Parallel(n_jobs = j)
+    if summary == "intervals":
+        results = METRICS.jobs(parallel, "read", readintervals, [ ([ regions[i] for i in rows ], rows, bigwig, extsize * 2, resolution) for rows in jobs ])
+    else:
+        results = METRICS.jobs(parallel, "read", binsums, [ ([ regions[i] for i in rows ], rows, bigwig, extsize * 2, resolution, summary == "exact") for rows in jobs ])
+    matrix = numpy.zeros((len(regions), extsize * 2 // resolution), dtype = numpy.float32 if resolution == 1 else numpy.float64)
+    for rows, x in results:
+        matrix[rows] = x
+    METRICS.count("regions_extracted", len(regions))
+    return numpy.round(matrix, BIN_DECIMALS) if resolution > 1 else matrix
+
+def binned(regions, bigwig, width, resolution = 1, summary = "bases"):
+    """
+    Reads the binned signal for a set of equally sized regions in the current process, as condensed by condense.
+
+    Args:
+        regions (list): regions to read, each as a tuple of chromosome, start, end, strand, sorted by position
+        bigwig (string): path to the BigWig file to read
+        width (int): number of basepairs in each region
+        resolution (int): bin size in basepairs
+        summary (string): how bins are computed: bases, by reading and condensing basepair values; exact or approximate,
+            with binsums, when resolution is above 1; or intervals, with readintervals
+
+    Returns:
+        A matrix with one row per region and one column per bin.
+    """
+    if summary == "intervals":
+        _, matrix = readintervals(regions, None, bigwig, width, resolution)
+    elif summary != "bases" and resolution > 1:
+        _, matrix = binsums(regions, None, bigwig, width, resolution, summary == "exact")
+    else:
+        _, matrix = read(regions, None, bigwig, width)
+        return condense(matrix, resolution)
+    return numpy.round(matrix, BIN_DECIMALS) if resolution > 1 else matrix
+
+def condense(a, r = 1, dr = BIN_DECIMALS):
+    """
+    Bins the columns of a signal matrix (or a single signal vector) by summing each consecutive run of r values.
+    Columns past the last complete bin are dropped.
+
+    Args:
+        a (numpy.ndarray): matrix or vector of signal values
+        r (int): number of values per bin; default is 1, in which case the input is returned unchanged
+        dr (int): number of decimal places to round binned values to; default is BIN_DECIMALS
+
+    Returns:
+        A float64 array with the same leading dimensions as the input and one column per bin.
     """
-    bw = pyBigWig.open(bigwig)
-    if bw is None:
-        raise Exception("Error opening %s: no such file or directory." % bigwig)
-    regions = centers if noextension else [
-        (chrom, x - extsize, x + extsize, strand) if x >= extsize and bw.chroms(chrom) is not None and x + extsize < bw.chroms(chrom) else None
-        for chrom, x, strand in centers
-    ]
-    divpoints = [ math.floor(len(regions) * i / j) for i in range(j) ] if len(regions) > j else list(range(len(regions)))
-    divpoints.append(len(regions))
-    if j == 1: divpoints = [ 0, len(regions) ]
-    readregions = Parallel(n_jobs = j)(delayed(read)(regions, divpoints, bigwig, i) for i in range(len(divpoints) - 1))
-    retval = []
-    for readregionset in readregions:
-        retval += readregionset
-    return retval
-
-def condense(a, r = 1, dr = 2):
     if r == 1: return a
-    rv = [ 0. for x in range(int(len(a) / r)) ]
-    for i in range(len(a)):
-        rv[int(math.floor(i / r))] += a[i]
-    return [ round(x, dr) for x in rv ]
+    bins = a.shape[-1] // r
+    binned = a[..., :bins * r].reshape(a.shape[:-1] + (bins, r))
+    return numpy.round(binned.sum(axis = -1, dtype = numpy.float64), dr)
+
+def foldgroups(groups, matrix):
+    """
+    Sums the rows of a matrix which belong to the same group, by sorting the rows by group and reducing each run.
+
+    Args:
+        groups (numpy.ndarray): group index of each row
+        matrix (numpy.ndarray): rows to sum
 
-def aggregate(bigwig, centers, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, noextension = False):
+    Returns:
+        Tuple of the sorted indexes of the groups which have rows, and a float64 matrix with the summed rows of each.
+    """
+    if len(groups) == 0: return groups[:0], numpy.zeros((0,) + matrix.shape[1:], dtype = numpy.float64)
+    if groups.min() == groups.max(): return groups[:1], matrix.sum(axis = 0, dtype = numpy.float64, keepdims = True)
+    order = numpy.argsort(groups, kind = "stable")
+    ordered = groups[order]
+    starts = numpy.flatnonzero(numpy.concatenate([ [ True ], ordered[1:] != ordered[:-1] ]))
+    return ordered[starts], numpy.add.reduceat(matrix[order], starts, axis = 0, dtype = numpy.float64)
+
+def accumulate(regions, groups, bigwig, width, resolution = 1, chunksize = 1000, summary = "bases"):
+    """
+    Reads signal for a set of regions and sums it by group without keeping the full matrix. Intended to be called in Parallel
+    on one job's share of the regions; regions are read in chunks, each of which is binned, folded by foldgroups and added to
+    the running sums.
+
+    Args:
+        regions (list): regions to read, each as a tuple of chromosome, start, end, strand, sorted by position
+        groups (numpy.ndarray): group index of each region
+        bigwig (string): path to the BigWig file to read
+        width (int): number of basepairs in each region
+        resolution (int): bin size in basepairs; rows are binned before being summed
+        chunksize (int): number of regions to read at a time
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see binned
+
+    Returns:
+        Tuple of the sorted indexes of the groups with regions in this share, and a float64 matrix of binned signal sums
+        with one row for each of those groups.
+    """
+    keys, sums = groups[:0], numpy.zeros((0, width // resolution), dtype = numpy.float64)
+    for i in range(0, len(regions), chunksize):
+        chunkkeys, chunksums = foldgroups(groups[i : i + chunksize], binned(regions[i : i + chunksize], bigwig, width, resolution, summary))
+        keys, sums = foldgroups(numpy.concatenate([ keys, chunkkeys ]), numpy.vstack([ sums, chunksums ]))
+    return keys, sums
+
+def summarize(regions, rows, bigwig, stat = "sum", exact = True):
+    """
+    Computes a summary statistic of the signal in each of a set of regions with pyBigWig's stats, without reading the
+    individual values. Intended to be called in Parallel on one job's share of the regions.
+
+    Args:
+        regions (list): regions to summarize, each as a tuple of chromosome, start, end, strand, sorted by position
+        rows (numpy.ndarray): index of each region in the complete result
+        bigwig (string): path to the BigWig file to read
+        stat (string): statistic to compute: sum, mean, max or coverage (the fraction of basepairs with signal)
+        exact (boolean): if set, statistics are computed from base-level data; otherwise they are approximated from the
+            BigWig's precomputed zoom level summaries
+
+    Returns:
+        A tuple of the rows parameter and a float64 vector with the statistic for each region. Regions which cannot be
+        read or which have no signal are zero.
+    """
+    bw = openbigwig(bigwig)
+    values = numpy.zeros(len(regions), dtype = numpy.float64)
+    for k, region in enumerate(regions):
+        try:
+            value = bw.stats(region[0], region[1], region[2], type = stat, exact = exact)[0]
+        except:
+            value = None
+        if value is not None: values[k] = value
+    return rows, values
+
+def regionstats(bigwig, centers, extsize, j = 8, stat = "sum", exact = True, noextension = False, parallel = None, intervals = False):
+    """
+    Computes a summary statistic of the signal around each of a set of center points in parallel, without building the
+    signal matrix; see summarize.
+
+    Args:
+        bigwig (string): path to the BigWig to read
+        centers (list): list of regions, each as a tuple of chromosome, center position, strand
+        extsize (int): number of basepairs to read around the center point
+        j (int): number of threads to use; default is 8
+        stat (string): statistic to compute: sum, mean, max or coverage
+        exact (boolean): if set, statistics are computed from base-level data rather than zoom level summaries
+        noextension (boolean): if set, centers are complete regions, as tuples of chromosome, start, end, strand, which are read as-is
+        parallel (joblib.Parallel): if passed, an existing worker pool to run the reads on, rather than a new pool of j workers
+        intervals (boolean): if set, statistics are computed from the BigWig's intervals with intervalstats; exact is ignored
+
+    Returns:
+        A float64 vector with the statistic for each region, in their original order. Regions which are missing from or out of
+        range for the bigWig are zero.
+    """
+    regions = centers if noextension else extend(bigwig, centers, extsize)
+    order = sortorder(regions)
+    divpoints = divide(regions, order, j)
+    if parallel is None: parallel = Parallel(n_jobs = j)
+    values = numpy.zeros(len(regions), dtype = numpy.float64)
+    jobs = [ order[divpoints[i]:divpoints[i + 1]] for i in range(len(divpoints) - 1) ]
+    if intervals:
+        results = METRICS.jobs(parallel, "stats", intervalstats, [ ([ regions[i] for i in rows ], rows, bigwig, stat) for rows in jobs ])
+    else:
+        results = METRICS.jobs(parallel, "stats", summarize, [ ([ regions[i] for i in rows ], rows, bigwig, stat, exact) for rows in jobs ])
+    for rows, x in results:
+        values[rows] = x
+    METRICS.count("regions_extracted", len(regions))
+    return values
+
+def groupedsums(bigwig, centers, groups, extsize, j = 8, resolution = 1, parallel = None, summary = "bases"):
+    """
+    Sums signal around a given set of center points by group in a single parallel pass. Each job keeps running per-group
+    sums of the binned signal for its share of the regions, so neither the complete matrix nor any per-group matrix is
+    ever built. For each region, if a strand is present and the region is on the minus strand, the order of the signal
+    values is reversed.
+
+    Args:
+        bigwig (string): path to the BigWig to read.
+        centers (list): list of regions, each as a tuple of chromosome, center position, strand
+        groups (list): group index of each region
+        extsize (int): number of basepairs to read around the center point; regions are extended by this amount in both directions
+        j (int): number of threads to use; default is 8
+        resolution (int): if set, sums bins of this number of basepairs
+        parallel (joblib.Parallel): if passed, an existing worker pool to run the reads on, rather than a new pool of j workers
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see binned
+
+    Returns:
+        Tuple of the sorted indexes of the groups with regions, a float64 matrix with one row for each of those groups,
+        where each row is the sum of the binned signal across that group's regions, and a vector with the number of regions
+        in each of those groups. Regions which are missing from or out of range for the bigWig are counted but contribute no
+        signal.
+    """
+    regions = extend(bigwig, centers, extsize)
+    groups = numpy.array(groups, dtype = numpy.int64)
+    keys, counts = numpy.unique(groups, return_counts = True)
+    order = sortorder(regions)
+    divpoints = divide(regions, order, j)
+    jobs = [ order[divpoints[i]:divpoints[i + 1]] for i in range(len(divpoints) - 1) ]
+    if parallel is None: parallel = Parallel(n_jobs = j)
+    results = METRICS.jobs(parallel, "accumulate", accumulate, [
+        ([ regions[i] for i in rows ], groups[rows], bigwig, extsize * 2, resolution, 1000, summary) for rows in jobs
+    ])
+    # regions out of range for the BigWig are not read, so a group may have no rows from any job
+    read, readsums = foldgroups(
+        numpy.concatenate([ keys[:0] ] + [ x for x, _ in results ]),
+        numpy.vstack([ numpy.zeros((0, extsize * 2 // resolution)) ] + [ x for _, x in results ])
+    )
+    sums = numpy.zeros((len(keys), extsize * 2 // resolution), dtype = numpy.float64)
+    sums[numpy.searchsorted(keys, read)] = readsums
+    METRICS.count("regions_extracted", len(regions))
+    return keys, sums, counts
+
+def groupedaggregate(bigwig, centers, groups, extsize, j = 8, resolution = 1, decimal_resolution = 2, ngroups = None, summary = "bases"):
+    """
+    Aggregates signal around a given set of center points by group in a single parallel pass; see groupedsums.
+
+    Returns:
+        A matrix with one row per group, or per group up to ngroups if it is given, where each row is the average binned
+        signal across that group's regions. Regions which are missing from or out of range for the bigWig count as vectors
+        of zeroes.
+    """
+    keys, sums, counts = groupedsums(bigwig, centers, groups, extsize, j, resolution, summary = summary)
+    if ngroups is None: ngroups = int(keys.max()) + 1 if len(keys) > 0 else 0
+    averages = numpy.zeros((ngroups, extsize * 2 // resolution), dtype = numpy.float64)
+    averages[keys] = numpy.round(sums / counts[:, None], decimal_resolution)
+    return averages
+
+def aggregate(
+    bigwig, centers, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, noextension = False, shared_memory = False,
+    parallel = None, cache = None, summary = "bases"
+):
     """
     Aggregates signal around a given set of center points from the given BigWig file. For each region, if a strand
     is present and the region is on the minus strand, the order of the signal values is reversed.
@@ -94,28 +555,39 @@ def aggregate(bigwig, centers, extsize, j = 8, startindex = 0, endindex = None,
         endindex (int): last index to aggregate (not inclusive); default is None, indicating aggregation should continue to the end of the list.
         resolution (int): if set, returns bins which represent the average signal across this number of basepairs
         decimal_resolution (int): rounds values in the matrix and aggregate vector to the given number of decimal places
+        noextension (boolean): if set, centers are complete regions which are read as-is
+        shared_memory (boolean): if set, parallel jobs write into a single shared memory-mapped matrix
+        parallel (joblib.Parallel): if passed, an existing worker pool to run the reads on, rather than a new pool of j workers
+        cache (cache.MatrixCache): if passed, a cache of basepair signal matrices to read from and add to
+        summary (string): how bins are computed: bases (the default) reads every basepair and sums them; exact and approximate
+            summarize each bin from base-level data or zoom levels respectively when resolution is above 1, and intervals
+            builds rows from the BigWig's intervals; see binmatrix. Other than bases, these do not use the cache or shared
+            memory. Ignored if noextension is set
 
     Returns:
         Tuple of aggregated and matrix-form results. The first element is a single vector of signal values, where each position
         is a bin with a size determined by the resolution parameter and the value is the average of the signal values from each
         region at that bin. The second element is the complete signal matrix, where each row is a region in the order of the "centers"
         parameter and each column is a bin. Regions which are missing from or out of range for the bigWig are represented by vectors
-        of zeroes.
+        of zeroes. Both are returned as NumPy arrays.
     """
     if endindex is None: endindex = len(centers)
-    if endindex <= startindex: return [], []
-    matrix = valuematrix(bigwig, centers[startindex : endindex], extsize, j, noextension)
-    if extsize is None: return None, matrix
-    for i in range(len(matrix)):
-        if len(matrix[i]) == 0: matrix[i] = [ 0. for _ in range(extsize * 2) ]
-    matrix = [ condense([ float(x) for x in xx ], resolution) for xx in numpy.nan_to_num(matrix) ]
-    aggregate = [
-        round(numpy.mean([ (x[i] if not numpy.isnan(x[i]) else 0.) for x in matrix ]), decimal_resolution)
-        for i in range(len(matrix[0]))
-    ]
+    if endindex <= startindex:
+        if extsize is None: return None, []
+        return numpy.zeros(0), numpy.zeros((0, extsize * 2 // resolution))
+    if (summary == "intervals" or summary != "bases" and resolution > 1) and not noextension and extsize is not None:
+        matrix = binmatrix(bigwig, centers[startindex : endindex], extsize, j, resolution, summary, parallel)
+    else:
+        matrix = valuematrix(bigwig, centers[startindex : endindex], extsize, j, noextension, shared_memory, parallel, cache)
+        if extsize is None: return None, matrix
+        with METRICS.stage("condense"): matrix = condense(matrix, resolution)
+    with METRICS.stage("condense"):
+        aggregate = numpy.round(matrix.mean(axis = 0, dtype = numpy.float64), decimal_resolution)
     return aggregate, matrix
 
-def bedaggregate(bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2):
+def bedaggregate(
+    bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, shared_memory = False, cache = None, summary = "bases"
+):
     """
     Aggregates signal around the center points of each region from a BED file, using signal from the given BigWig file.
     If the BED file has strand information, regions on the minus strand will be inverted before being aggregated; otherwise,
@@ -130,6 +602,9 @@ def bedaggregate(bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, r
         endindex (int): last index to aggregate (not inclusive); default is None, indicating aggregation should continue to the end of the list
         resolution (int): if set, returns bins which represent the average signal across this number of basepairs
         decimal_resolution (int): rounds values in the matrix and aggregate vector to the given number of decimal places
+        shared_memory (boolean): if set, parallel jobs write into a single shared memory-mapped matrix
+        cache (cache.MatrixCache): if passed, a cache of basepair signal matrices to read from and add to
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see aggregate
 
     Returns:
         Tuple of aggregated and matrix-form results. The first element is a single vector of signal values, where each position
@@ -138,52 +613,160 @@ def bedaggregate(bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, r
         "centers" parameter and each column is a bin. Regions which are missing from or out of range for the bigWig are represented
         by vectors of zeroes.
     """
-    if not os.path.exists(bed):
-        raise Exception("Error opening %s: no such file or directory." % bed)
-    with (gzip.open if bed.endswith(".gz") else open)(bed, 'rt') as f:
-        centers = [ summit(l) for l in f ]
-    return aggregate(bigwig, centers, extsize, j, startindex, endindex, resolution, decimal_resolution)
-
-def summit(l):
-    return (
-        l.split()[0],
-        int((int(l.split()[2].strip()) + int(l.split()[1])) / 2),
-        l.split()[3].strip() if len(l.split()) >= 4 else '.'
-    )
+    centers = loadbed(bed, startindex, endindex).centers() if endindex is None or endindex > startindex else []
+    return aggregate(bigwig, centers, extsize, j, 0, None, resolution, decimal_resolution, shared_memory = shared_memory, cache = cache, summary = summary)
+
+def inrange(groups, ngroups, startindex = 0, endindex = None):
+    """
+    Finds which regions fall within an index range counted separately within each group.
+
+    Args:
+        groups (numpy.ndarray): group number of each region, in file order
+        ngroups (int): number of groups
+        startindex (int or numpy.ndarray): first index within each group to keep (inclusive); may be given per group
+        endindex (int or numpy.ndarray): last index within each group to keep (not inclusive), or None for no limit
+
+    Returns:
+        A boolean vector which is set for each region whose index within its group is in range.
+    """
+    order = numpy.argsort(groups, kind = "stable")
+    sizes = numpy.bincount(groups, minlength = ngroups)
+    ranks = numpy.empty(len(groups), dtype = numpy.int64)
+    ranks[order] = numpy.arange(len(groups)) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+    keep = ranks >= numpy.broadcast_to(startindex, ngroups)[groups]
+    if endindex is not None: keep &= ranks < numpy.broadcast_to(endindex, ngroups)[groups]
+    return keep
 
-def bedAggregateByName(bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2):
+def bedAggregateByName(bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, summary = "bases"):
     """
     Aggregates signal around the center points of each region from a BED file, using signal from the given BigWig file.
     If the BED file has strand information, regions on the minus strand will be inverted before being aggregated; otherwise,
     all regions are assumed to be the same orientation. Results are grouped by the names in the fourth field of the BED file;
-    strand information, if present, must be given in the fifth field.
+    strand information, if present, must be given in the fifth field. All groups are aggregated together in a single pass.
 
     Args:
         bigwig (string): path to the BigWig to read
         bed (string): path to the BED file containing the regions to aggregate
         extsize (int): number of basepairs to read around the center point; regions are extended by this amount in both directions
         j (int): number of threads to use; default is 8
-        startindex (int): first index to aggregate (inclusive); default is 0
-        endindex (int): last index to aggregate (not inclusive); default is None, indicating aggregation should continue to the end of the list
+        startindex (int): first index within each group to aggregate (inclusive); default is 0
+        endindex (int): last index within each group to aggregate (not inclusive); default is None, indicating aggregation should continue to the end of the group
         resolution (int): if set, returns bins which represent the average signal across this number of basepairs
         decimal_resolution (int): rounds values in the matrix and aggregate vector to the given number of decimal places
-        name_by_coordinates (boolean): if true, names are coordinate ranges rather than values in the name field
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see aggregate
 
     Returns:
         Dictionary of aggregated results. Keys are names from the fourth BED field. Values are vectors of signal values, where each
         position is a bin with a size determined by the resolution parameter and the value is the average of the signal values from each
         region at that basepair.
     """
-    if not os.path.exists(bed):
-        raise Exception("Error opening %s: no such file or directory." % bed)
-    centers = {}
-    with (gzip.open if bed.endswith(".gz") else open)(bed, 'rt') as f:
-        for line in f:
-            line = line.strip().split()
-            if line[3] not in centers: centers[line[3]] = []
-            centers[line[3]].append((
-                line[0],
-                int((int(line[2]) + int(line[1])) / 2),
-                line[4] if len(line) >= 5 else '.'
-            ))
-    return { k: aggregate(bigwig, v, extsize, j, startindex, endindex, resolution, decimal_resolution)[0] for k, v in centers.items() }
+    regions = loadbed(bed)
+    names = {}
+    groups = numpy.array([ names.setdefault(x, len(names)) for x in regions.fourth ], dtype = numpy.int64)
+    keep = numpy.flatnonzero(inrange(groups, len(names), startindex, endindex))
+    centers = regions.centers(4)
+    centers, groups = [ centers[i] for i in keep ], groups[keep]
+    aggregates = groupedaggregate(bigwig, centers, groups, extsize, j, resolution, decimal_resolution, len(names), summary)
+    counts = numpy.bincount(groups, minlength = len(names))
+    return { k: aggregates[i] if counts[i] > 0 else numpy.zeros(0) for k, i in names.items() }
+
+def grow(a, n):
+    """
+    Returns:
+        The given array if it has at least n rows; otherwise a copy extended with rows of zeroes to at least n rows, and to
+        at least twice its length, so that growing an array a row at a time copies it only a logarithmic number of times.
+    """
+    if len(a) >= n: return a
+    grown = numpy.zeros((max(n, 2 * len(a)),) + a.shape[1:], dtype = a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+def streamsums(
+    bigwigs, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, grouped = False, batchsize = 1000, lines = (0, None), summary = "bases"
+):
+    """
+    Sums binned signal around the center points of each region from a BED file, reading the file in batches and folding each
+    batch into running per-bin sums and counts, so memory use does not grow with the number of regions. The BED file is read
+    once however many BigWigs are summed, and every batch and BigWig is read by one engine.ExtractionEngine. Regions on the
+    minus strand are inverted before being summed.
+
+    Args:
+        bigwigs (list): paths to the BigWigs to read
+        bed (string): path to the BED file containing the regions to sum
+        extsize (int): number of basepairs to read around the center point; regions are extended by this amount in both directions
+        j (int): number of threads to use; default is 8
+        startindex (int): first index to sum (inclusive), within each group if grouped; default is 0
+        endindex (int): last index to sum (not inclusive), within each group if grouped; default is None, indicating summing should continue to the end
+        resolution (int): if set, sums bins which represent the average signal across this number of basepairs
+        grouped (boolean): if set, results are grouped by the names in the fourth field and strand is read from the fifth
+        batchsize (int): number of BED lines to read at a time; default is 1000
+        lines (tuple): first (inclusive) and last (not inclusive, or None) index of the BED lines to read; default is every line
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see binned
+
+    Returns:
+        Tuple of a dictionary mapping each group name (None if not grouped) to its row number, a list with a float64 matrix of
+        the summed signal for each group from each BigWig, and a vector with the number of regions summed in each group.
+    """
+    from .engine import ExtractionEngine
+    if startindex < 0 or (endindex is not None and endindex < 0):
+        raise Exception(
+            "Error: negative start and end indexes are not supported when aggregating in batches (--streaming, --stacked or several "
+            "signal files); count indexes from the start of the file."
+        )
+    names, sizes = {}, numpy.zeros(0, dtype = numpy.int64)
+    sums, counts = [ numpy.zeros((0, extsize * 2 // resolution)) for _ in bigwigs ], numpy.zeros(0, dtype = numpy.int64)
+    with BedReader(bed, batchsize, *lines) as f, ExtractionEngine(bigwigs, j) as engine:
+        for batch in f:
+            groups = numpy.array([ names.setdefault(x, len(names)) for x in (batch.fourth if grouped else [ None ] * len(batch)) ], dtype = numpy.int64)
+            # only the groups in this batch are indexed, so the cost of a batch does not grow with the number of groups seen
+            keys, local, batchsizes = numpy.unique(groups, return_inverse = True, return_counts = True)
+            sizes = grow(sizes, len(names))
+            keep = numpy.flatnonzero(inrange(local, len(keys), startindex - sizes[keys], None if endindex is None else endindex - sizes[keys]))
+            sizes[keys] += batchsizes
+            centers = batch.centers(4 if grouped else 3)
+            centers, groups = [ centers[i] for i in keep ], groups[keep]
+            for k, bigwig in enumerate(bigwigs):
+                batchkeys, batchsums, batchcounts = engine.sums(centers, groups, extsize, resolution, bigwig, summary)
+                sums[k] = grow(sums[k], len(names))
+                sums[k][batchkeys] += batchsums
+            counts = grow(counts, len(names))
+            counts[batchkeys] += batchcounts
+    return names, [ x[:len(names)] for x in sums ], counts[:len(names)]
+
+def averages(names, sums, counts, decimal_resolution = 2, grouped = False):
+    """
+    Converts summed signal, as from streamsums, to aggregate vectors.
+
+    Returns:
+        If grouped, a dictionary mapping each group name to its average signal, rounded to the given number of decimal places,
+        or an empty vector if the group has no regions; otherwise, the average signal for the single group.
+    """
+    aggregates = [ numpy.round(sums[i] / counts[i], decimal_resolution) if counts[i] > 0 else numpy.zeros(0) for i in range(len(names)) ]
+    if grouped: return { k: aggregates[i] for k, i in names.items() }
+    return aggregates[0] if len(aggregates) > 0 else numpy.zeros(0)
+
+def streamaggregate(
+    bigwig, bed, extsize, j = 8, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, grouped = False, batchsize = 1000, summary = "bases"
+):
+    """
+    Aggregates signal around the center points of each region from a BED file in constant memory; see streamsums. Regions on
+    the minus strand are inverted before being aggregated, as for bedaggregate and bedAggregateByName.
+
+    Args:
+        bigwig (string): path to the BigWig to read
+        bed (string): path to the BED file containing the regions to aggregate
+        extsize (int): number of basepairs to read around the center point; regions are extended by this amount in both directions
+        j (int): number of threads to use; default is 8
+        startindex (int): first index to aggregate (inclusive), within each group if grouped; default is 0
+        endindex (int): last index to aggregate (not inclusive), within each group if grouped; default is None, indicating aggregation should continue to the end
+        resolution (int): if set, returns bins which represent the average signal across this number of basepairs
+        decimal_resolution (int): rounds values in the aggregate vectors to the given number of decimal places
+        grouped (boolean): if set, results are grouped by the names in the fourth field and strand is read from the fifth
+        batchsize (int): number of BED lines to read at a time; default is 1000
+        summary (string): how bins are computed: bases, exact, approximate or intervals; see binned
+
+    Returns:
+        If grouped, a dictionary with the same contents as bedAggregateByName; otherwise, the aggregate vector from bedaggregate.
+    """
+    names, sums, counts = streamsums([ bigwig ], bed, extsize, j, startindex, endindex, resolution, grouped, batchsize, summary = summary)
+    return averages(names, sums[0], counts, decimal_resolution, grouped)
@@ -4,159 +4,454 @@ import os
 import ujson
 import numpy
 import math
+import shutil
 import tempfile
-from joblib import Parallel, delayed
+from contextlib import ExitStack
 
-from .aggregate import bedaggregate, bedAggregateByName, summit, aggregate
-from .sequence.twobit import TwoBitReader
-from .batch.batch import batch_size, flatten, BatchedFile
+# modules which load joblib or pyBigWig (aggregate, engine) are imported by the subcommands which use them, so that other
+# subcommands start without loading them
+from .sequence.twobit import reader
+from .sequence.onehot import onehotarray
+from .batch.batch import batch_size, flatten, prefetch
+from .bed.bed import BedReader, loadbed, bedrange
+from .matrixfile.matrixfile import MatrixFileReader, MatrixFileWriter, BIN_DECIMALS
+from .shard.shard import writepartial, mergepartials, ismatrixfile, shardrows
+from .metrics.metrics import METRICS
+from .cache.cache import MatrixCache
+from .checkpoint.checkpoint import Checkpoint, sync
+
+BUFFER_SIZE = 1 << 20
+
+def encode(x):
+    with METRICS.stage("encode"):
+        return ujson.dumps(x)
+
+def emit(o, text):
+    """
+    Writes text to an output file, recording the time taken and the number of bytes written.
+    """
+    with METRICS.stage("write"):
+        o.write(text)
+    METRICS.count("bytes_written", len(text))
+
+def signalcache(args):
+    """
+    Returns:
+        The signal matrix cache selected by --cache-dir and --cache-max-size, or None if no cache directory was given.
+    """
+    if args.cache_dir is None: return None
+    return MatrixCache(args.cache_dir, args.cache_max_size << 20)
+
+def signaltracks(args):
+    """
+    Returns:
+        List of the BigWigs given by --signal-file and --signal-manifest, as tuples of track name and path. Tracks are named
+        for their file name without its extension, unless the manifest gives a name before the path, separated by a tab.
+    """
+    files = args.signal_file if isinstance(args.signal_file, list) else ([ args.signal_file ] if args.signal_file is not None else [])
+    tracks = [ (os.path.splitext(os.path.basename(x))[0], x) for x in files ]
+    if args.signal_manifest is not None:
+        with open(args.signal_manifest, 'r') as f:
+            for line in f:
+                fields = line.strip().split('\t')
+                if len(fields[0]) == 0 or fields[0].startswith('#'): continue
+                tracks.append((fields[0], fields[1]) if len(fields) > 1 else (os.path.splitext(os.path.basename(fields[0]))[0], fields[0]))
+    if len(tracks) == 0:
+        raise Exception("Error: no signal files given; pass --signal-file or --signal-manifest.")
+    names = [ name for name, _ in tracks ]
+    for name in names:
+        if names.count(name) > 1:
+            raise Exception("Error: track name %s is used by more than one signal file." % name)
+    return tracks
+
+def trackoutputs(args, tracks):
+    """
+    Returns:
+        The output path for each track: --output-file itself for a single track; otherwise --output-file with {track}
+        replaced by the track name, or with the track name added before the extension if there is no {track}.
+    """
+    if len(tracks) == 1: return [ args.output_file ]
+    if "{track}" in args.output_file: return [ args.output_file.replace("{track}", name) for name, _ in tracks ]
+    root, extension = os.path.splitext(args.output_file)
+    return [ "%s.%s%s" % (root, name, extension) for name, _ in tracks ]
 
 def runaggregate(args):
-    if not args.grouped:
+    from .aggregate import bedaggregate, bedAggregateByName, streamaggregate, streamsums, averages
+    tracks = signaltracks(args)
+    if args.shard or args.stacked or len(tracks) > 1:
+        indexes, lines = ((0, None), (args.start_index, args.end_index)) if args.shard else ((args.start_index, args.end_index), (0, None))
+        names, sums, counts = streamsums(
+            [ x for _, x in tracks ], args.bed_file, args.extsize, args.j, indexes[0], indexes[1], args.resolution, args.grouped, batch_size(args), lines,
+            args.summary
+        )
+        if args.shard:
+            metadata = { "extsize": args.extsize, "resolution": args.resolution, "decimal_resolution": args.decimal_resolution, "grouped": args.grouped }
+            for path, x in zip(trackoutputs(args, tracks), sums):
+                writepartial(path, names, x, counts, metadata)
+            return
+        values = [ averages(names, x, counts, args.decimal_resolution, args.grouped) for x in sums ]
+        values = [ { k: v.tolist() for k, v in x.items() } if args.grouped else x.tolist() for x in values ]
+        if args.stacked:
+            with open(args.output_file, 'w') as o:
+                emit(o, encode({ name: x for (name, _), x in zip(tracks, values) }) + '\n')
+            return
+        for path, x in zip(trackoutputs(args, tracks), values):
+            with open(path, 'w') as o:
+                emit(o, encode(x) + '\n')
+        return
+    signal_file = tracks[0][1]
+    if args.streaming:
+        values = streamaggregate(
+            signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution,
+            args.grouped, batch_size(args), args.summary
+        )
+        values = { k: v.tolist() for k, v in values.items() } if args.grouped else values.tolist()
+    elif not args.grouped:
         values, _ = bedaggregate(
-            args.signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution
+            signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution, args.shared_memory,
+            signalcache(args), args.summary
         )
+        values = values.tolist()
     else:
         values = bedAggregateByName(
-            args.signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution
+            signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution, args.summary
         )
+        values = { k: v.tolist() for k, v in values.items() }
     with open(args.output_file, 'w') as o:
-        o.write(ujson.dumps(values) + '\n')
+        emit(o, encode(values) + '\n')
 
-def tregion(line):
-    x = line.strip().split()
-    x[1] = int(x[1]); x[2] = int(x[2])
-    if len(x) <= 3: return tuple(x + [ '.' ])
-    return tuple(x[:4])
+def zscores(values):
+    """
+    Converts a summary statistic for each region to Z-scores of its log. Regions with no signal are given the lowest score
+    rounded down to an integer.
+
+    Returns:
+        Tuple of a float64 vector of scores, a boolean vector which is set for each region with signal, and the integer
+        score given to regions without signal.
+    """
+    with METRICS.stage("normalize"):
+        present = values > 0
+        logs = numpy.log(values[present])
+        mean, std = logs.mean(), logs.std()
+        minv = math.floor((logs.min() - mean) / std)
+        scores = numpy.full(len(values), minv, dtype = numpy.float64)
+        scores[present] = (logs - mean) / std
+    return scores, present, minv
 
 def runzscore(args):
+    from .engine import ExtractionEngine
     batchsize = batch_size(args)
-    batches = []
-    def mean(cbatch):
-        cbatch = [ x for x in cbatch if x is not None ]
-        _, matrix = aggregate(
-            args.signal_file, cbatch, args.extsize, args.j, args.start_index, args.end_index, noextension = args.extsize is None
-        )
-        return [ sum(x) if len(x) > 0 else 0 for x in matrix ]
-    with BatchedFile(args.bed_file, batchsize) as f:
-        batches = [ [ summit(x) if args.extsize is not None else tregion(x) for x in batch ] for batch in f ]
-    results = flatten( Parallel(n_jobs = args.j)(delayed(mean)(x) for x in batches) )
-    mean = numpy.mean([ math.log(x) for x in results if x > 0 ])
-    std = numpy.std([ math.log(x) for x in results if x > 0 ])
-    minv = math.floor((min([ math.log(x) for x in results if x > 0 ]) - mean) / std)
-    results = [ (math.log(x) - mean) / std if x > 0 else minv for x in results ]
-    with open(args.bed_file, 'r') as f:
-        with open(args.output_file, 'w') as o:
-            if args.json:
-                o.write(ujson.dumps(results) + '\n')
-            else:
-                i = 0
-                for line in f:
-                    o.write("%s\t%.3f\n" % ('\t'.join(line.strip().split()[:4]), results[i]))
-                    i += 1
+    with BedReader(args.bed_file, batchsize) as f:
+        batches = [ batch[args.start_index:args.end_index] for batch in f ]
+    def score(batch):
+        regions = batch.centers() if args.extsize is not None else batch.regions()
+        return engine.stats(regions, args.extsize, args.stat, not args.approximate, args.extsize is None, args.intervals)
+    with ExtractionEngine(args.signal_file, args.j) as engine:
+        results = numpy.concatenate([ numpy.zeros(0) ] + [ score(x) for x in batches ])
+    scores, present, minv = zscores(results)
+    with open(args.output_file, 'w') as o:
+        if args.json:
+            emit(o, encode([ x if p else minv for x, p in zip(scores.tolist(), present.tolist()) ]) + '\n')
+        else:
+            fields = flatten([ batch.lines() for batch in batches ])
+            for i in range(0, len(fields), batchsize):
+                with METRICS.stage("encode"):
+                    text = ''.join([ "%s\t%.3f\n" % x for x in zip(fields[i:i + batchsize], scores[i:i + batchsize].tolist()) ])
+                emit(o, text)
+        METRICS.count("rows_written", len(scores))
 
 def sregion(summit, extsize):
     c, s, _ = summit
     return "%s:%d-%d" % (c, s - extsize, s + extsize)
 
+def jsonoutput(args, path = None):
+    path = path if path is not None else args.output_file
+    if args.random_access:
+        return tempfile.TemporaryFile('w+', buffering = BUFFER_SIZE, dir = os.path.dirname(os.path.abspath(path)))
+    return open(path, 'w', buffering = BUFFER_SIZE)
+
+def writeindexed(path, lengths, rows):
+    """
+    Writes random access JSON output: a JSON list with the length of each row, followed by the rows themselves, one per
+    line, copied from the given temporary file.
+    """
+    rows.seek(0)
+    with open(path, 'w', buffering = BUFFER_SIZE) as o:
+        emit(o, encode(lengths) + '\n')
+        with METRICS.stage("write"):
+            shutil.copyfileobj(rows, o, BUFFER_SIZE)
+
+def jsonrows(matrix, keys = None):
+    """
+    Encodes a block of matrix rows as they appear inside the JSON list of all rows, or inside a coordinate map if keys
+    are given, without the enclosing brackets; joining consecutive blocks with commas gives the same text as encoding
+    the whole matrix at once.
+
+    Args:
+        matrix (numpy.ndarray): the rows
+        keys (list): optional coordinate string for each row
+    """
+    with METRICS.stage("encode"):
+        values = matrix.tolist()
+        if keys is not None: values = dict(zip(keys, values))
+        return ujson.dumps(values)[1:-1]
+
 def runmatrix(args):
-    if args.streaming:
-        runmatrix_stream(args)
+    tracks = signaltracks(args)
+    if args.streaming or args.format == "binary" or args.shard or args.stacked or args.resume or len(tracks) > 1:
+        runmatrix_stream(args, tracks)
     else:
-        runmatrix_all(args)
+        runmatrix_all(args, tracks[0][1])
+
+class MatrixOutput:
+    """
+    Matrix output in the format selected by args: a JSON list or coordinate map, random access JSON, or a binary matrix
+    file. Rows are written as they arrive. If journal is given the output can be checkpointed, and continues from the
+    last of the states in the journal; random access rows are then kept in a file next to the output rather than a
+    temporary file, so that they survive the run being interrupted.
+
+    Args:
+        args: parsed command line arguments, with coordinate_map, random_access and dtype set
+        path (string): path to write the output to
+        metadata (dict): metadata to record in binary output
+        binary (boolean): if set, writes a binary matrix file; otherwise writes JSON
+        dtype: dtype of binary output; default args.dtype
+        journal (list): states recorded by checkpoint for earlier batches, as from checkpoint.Checkpoint.states
+    """
+
+    def __init__(self, args, path, metadata = None, binary = False, dtype = None, journal = None):
+        self.args = args
+        self.path = path
+        self.metadata = metadata
+        self.binary = binary
+        self.dtype = dtype if dtype is not None else args.dtype
+        self.journal = journal
+        self.plain = not binary and not args.random_access
+        self.rowspath = path + ".rows" if journal is not None and not self.plain and not binary else None
+        self.first = True
+        self.lengths = []
+        self.recorded = 0
+
+    def __enter__(self):
+        if self.journal is None or len(self.journal) == 0:
+            if self.binary:
+                self.output = MatrixFileWriter(self.path, self.dtype, self.metadata).__enter__()
+            else:
+                self.output = open(self.rowspath, 'w+', buffering = BUFFER_SIZE) if self.rowspath is not None else jsonoutput(self.args, self.path)
+            if self.plain: self.output.write("{" if self.args.coordinate_map else "[")
+            return self
+        last = self.journal[-1]
+        self.first = last["first"]
+        self.lengths = flatten([ x["lengths"] for x in self.journal ])
+        self.recorded = len(self.lengths)
+        if self.binary:
+            self.output = MatrixFileWriter(self.path, self.dtype, self.metadata).resume(
+                last["rows"], last["rowshape"], last["regions"], last["chromosomes"], last["offset"]
+            )
+        else:
+            self.output = open(self.rowspath if self.rowspath is not None else self.path, 'r+', buffering = BUFFER_SIZE)
+            self.output.truncate(last["offset"])
+            self.output.seek(last["offset"])
+        return self
 
-def runmatrix_stream(args):
-    batch = []
+    def write(self, regions, matrix):
+        """
+        Writes a batch of rows.
+
+        Args:
+            regions (list): the region read for each row, as a tuple of chromosome, start, end
+            matrix (numpy.ndarray): the rows
+        """
+        if self.binary:
+            with METRICS.stage("write"):
+                self.output.write(matrix, regions)
+            METRICS.count("bytes_written", matrix.size * self.output.dtype.itemsize)
+        elif self.args.random_access:
+            with METRICS.stage("encode"):
+                dumped = [ ujson.dumps(x) + '\n' for x in matrix.tolist() ]
+            emit(self.output, "".join(dumped))
+            self.lengths += [ len(x) for x in dumped ]
+        elif len(matrix) > 0:
+            keys = [ "%s:%d-%d" % region for region in regions ] if self.args.coordinate_map else None
+            emit(self.output, ("," if not self.first else "") + jsonrows(matrix, keys))
+            self.first = False
+        METRICS.count("rows_written", len(matrix))
+
+    def checkpoint(self):
+        """
+        Flushes the rows written so far to disk.
+
+        Returns:
+            The state of the output, for checkpoint.Checkpoint.record; the random access index entries in the state are
+            only those added since the previous call. Binary output records its counts of rows and region coordinates.
+        """
+        handle = self.output.handle if self.binary else self.output
+        sync(handle)
+        state = { "offset": handle.tell(), "first": self.first, "lengths": self.lengths[self.recorded:] }
+        self.recorded = len(self.lengths)
+        if self.binary:
+            sync(self.output.regionhandle)
+            state.update(
+                rows = self.output.rows, rowshape = self.output.rowshape, regions = self.output.regions, chromosomes = list(self.output.chromosomes)
+            )
+        return state
+
+    def __exit__(self, *args):
+        try:
+            if args[0] is None and self.plain: self.output.write("}\n" if self.args.coordinate_map else "]\n")
+            if args[0] is None and not self.binary and self.args.random_access: writeindexed(self.path, self.lengths, self.output)
+        finally:
+            self.output.__exit__(*args)
+        if args[0] is None and self.rowspath is not None: os.remove(self.rowspath)
+
+def resumable(args, stack, settings):
+    """
+    Returns:
+        The run's checkpoint.Checkpoint, entered on the given ExitStack, if --resume is set; otherwise None.
+    """
+    if not args.resume: return None
+    return stack.enter_context(Checkpoint(args.output_file + ".checkpoint", settings))
+
+def runmatrix_stream(args, tracks):
+    from .engine import ExtractionEngine
     batchsize = batch_size(args)
-    first = True
-    def write(cbatch, o, first = True):
-        _, matrix = aggregate(
-            args.signal_file, cbatch, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution
-        )
-        if args.coordinate_map: matrix = { sregion(cbatch[i], args.extsize): x for i, x in enumerate(matrix) }
-        o.write(("," if not first else "") + ujson.dumps(matrix)[1:-1])
-        first = False
-        return []
-    def writeSeekable(cbatch, o, _):
-        _, matrix = aggregate(
-            args.signal_file, cbatch, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution
-        )
-        dumped = [ ujson.dumps(x) + '\n' for x in matrix ]
-        o.write("".join(dumped))
-        return [ len(x) for x in dumped ]
-    r = []
-    with open(args.output_file, 'w') as o:
-        if not args.random_access: o.write("{" if args.coordinate_map else "[")
-        with BatchedFile(args.bed_file, batchsize) as f:
-            for batch in f:
-                r += (writeSeekable if args.random_access else write)([ summit(x) for x in batch ], o, first)
-                first = False
-        if not args.random_access: o.write("}\n" if args.coordinate_map else "]\n")
-    if args.random_access:
-        with tempfile.NamedTemporaryFile('wt') as tf:
-            tf.write(ujson.dumps(r) + '\n')
-            tf.flush()
-            with tempfile.NamedTemporaryFile() as ff:
-                os.system("cat %s %s > %s && cp %s %s" % (tf.name, args.output_file, ff.name, ff.name, args.output_file))
+    # --streaming applies --start-index and --end-index within each batch, as it always has; every other route here applies them
+    # to the lines of the BED file, as matrix does when the whole file is read at once
+    streamed = args.streaming and not args.shard
+    lines, window = ((0, None), (args.start_index, args.end_index)) if streamed else (bedrange(args.bed_file, args.start_index, args.end_index), (0, None))
+    paths = [ x for _, x in tracks ]
+    def extract(batch):
+        cbatch = batch.centers()
+        matrices = [
+            engine.aggregate(
+                cbatch, args.extsize, window[0], window[1], args.resolution, args.decimal_resolution, shared_memory = args.shared_memory, bigwig = x,
+                summary = args.summary
+            )[1] for x in paths
+        ]
+        return [ (c, x - args.extsize, x + args.extsize) for c, x, _ in cbatch[window[0]:window[1]] ], matrices
+    def metadata(files):
+        metadata = dict(files, extsize = args.extsize, resolution = args.resolution)
+        if args.shard: metadata["shard"] = [ args.start_index, args.end_index ]
+        return metadata
+    binary = args.format == "binary" or args.shard
+    # shards keep float64 rows whatever --dtype is, so that merge writes the same values as an unsharded run
+    dtype = numpy.float64 if args.shard else None
+    settings = { k: getattr(args, k) for k in (
+        "bed_file", "extsize", "resolution", "decimal_resolution", "start_index", "end_index", "coordinate_map", "random_access", "format", "dtype", "shard",
+        "stacked", "summary"
+    ) }
+    settings.update(tracks = tracks, batch_size = batchsize)
+    with ExitStack() as stack:
+        checkpoint = resumable(args, stack, settings)
+        done = checkpoint.batches if checkpoint is not None else 0
+        # each batch written covers batchsize lines of the selected range, so the run continues that many lines past its start
+        f = stack.enter_context(BedReader(args.bed_file, batchsize, lines[0] + done * batchsize, lines[1]))
+        engine = stack.enter_context(ExtractionEngine(paths, args.j, signalcache(args)))
+        if args.stacked:
+            outputs = [ (args.output_file, metadata({ "signal_files": paths, "tracks": [ x for x, _ in tracks ] })) ]
+        else:
+            outputs = [ (output, metadata({ "signal_file": x })) for output, x in zip(trackoutputs(args, tracks), paths) ]
+        outputs = [
+            stack.enter_context(MatrixOutput(args, output, x, binary, dtype, checkpoint.states(i) if checkpoint is not None else None))
+            for i, (output, x) in enumerate(outputs)
+        ]
+        for regions, matrices in prefetch((extract(batch) for batch in f), args.inflight_batches):
+            if args.stacked:
+                outputs[0].write(regions, numpy.stack(matrices, axis = 1))
+            else:
+                for o, matrix in zip(outputs, matrices): o.write(regions, matrix)
+            if checkpoint is not None: checkpoint.record([ o.checkpoint() for o in outputs ])
 
-def runmatrix_all(args):
+def runmatrix_all(args, signal_file):
+    from .aggregate import bedaggregate
     _, matrix = bedaggregate(
-        args.signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution
+        signal_file, args.bed_file, args.extsize, args.j, args.start_index, args.end_index, args.resolution, args.decimal_resolution, args.shared_memory,
+        signalcache(args), args.summary
     )
+    batchsize, keys, order = batch_size(args), None, numpy.arange(len(matrix))
     if args.coordinate_map:
-        with open(args.bed_file, 'r') as f:
-            matrix = { sregion(summit(f.readline()), args.extsize): x for x in matrix }
-    with open(args.output_file, 'w') as o:
-        o.write(ujson.dumps(matrix) + '\n')
-
-def seqregion(line, extsize):
-    line = line.strip().split()
-    m = int((int(line[1]) + int(line[2])) / 2)
-    return line[0], m - extsize, m + extsize
+        # as in a JSON object built from every row, a repeated region keeps its first position and its last row
+        centers = loadbed(args.bed_file, args.start_index, args.end_index).centers()
+        positions = { sregion(c, args.extsize): i for c, i in zip(centers, order) }
+        keys, order = list(positions), numpy.fromiter(positions.values(), dtype = numpy.int64, count = len(positions))
+    with open(args.output_file, 'w', buffering = BUFFER_SIZE) as o:
+        emit(o, "{" if keys is not None else "[")
+        for i in range(0, len(order), batchsize):
+            text = jsonrows(matrix[order[i:i + batchsize]], keys[i:i + batchsize] if keys is not None else None)
+            emit(o, ("," if i > 0 else "") + text)
+        emit(o, "}\n" if keys is not None else "]\n")
+    METRICS.count("rows_written", len(matrix))
 
 def runsequence(args):
-    if args.streaming:
+    if args.streaming or args.format == "binary" or args.resume:
         runsequence_stream(args)
     else:
         runsequence_all(args)
 
+def sequences(twobit, regions, extsize, cache = 0):
+    """
+    Reads sequence for a batch of regions from a 2bit file. Intended to be called in Parallel; each process keeps its
+    own reader open on the 2bit file.
+
+    Args:
+        twobit (string): path to the 2bit file to read
+        regions (list): regions to read, as tuples of chromosome, start, end, each extsize * 2 basepairs long
+        extsize (int): number of basepairs read on either side of each center point
+        cache (int): size in bytes of the decoded chromosome cache kept by the reader; default 0 (no cache)
+
+    Returns:
+        Tuple of the regions parameter and a uint8 matrix of base codes with one row per region.
+    """
+    t = reader(twobit, cache)
+    codes = [ t.codes(*x) for x in regions ]
+    return regions, numpy.array(codes, dtype = numpy.uint8).reshape(len(regions), extsize * 2)
+
 def runsequence_stream(args):
-    batch = []
+    from joblib import Parallel
     batchsize = batch_size(args)
-    first = True
-    def write(cbatch, t, o, last = False):
-        if not args.coordinate_map:
-            results = [ t.read(*seqregion(x, args.extsize)) for x in cbatch ]
-        else:
-            results = { "%s:%s-%s" % seqregion(x, args.extsize): t.read(*seqregion(x, args.extsize)) for x in cbatch }
-        o.write(("," if not first else "") + ujson.dumps(results)[1:-1])
-        return []
-    def writeSeekable(cbatch, t, o, _):
-        dumped = [ ujson.dumps(t.read(*seqregion(x, args.extsize))) + '\n' for x in cbatch ]
-        o.write("".join(dumped))
-        return [ len(x) for x in dumped ]
-    r = []
-    with open(args.output_file, 'w') as o:
-        if not args.random_access: o.write("{" if args.coordinate_map else "[")
-        with TwoBitReader(args.two_bit_file) as t:
-            with BatchedFile(args.bed_file, batchsize) as f:
-                for batch in f:
-                    r += (writeSeekable if args.random_access else write)(batch, t, o, first)
-                    first = False
-        if not args.random_access: o.write("}\n" if args.coordinate_map else "]\n")
-    if args.random_access:
-        with tempfile.NamedTemporaryFile('wt') as tf:
-            tf.write(ujson.dumps(r) + '\n')
-            tf.flush()
-            with tempfile.NamedTemporaryFile() as ff:
-                os.system("cat %s %s > %s && cp %s %s" % (tf.name, args.output_file, ff.name, ff.name, args.output_file))
+    binary = args.format == "binary"
+    metadata = { "two_bit_file": args.two_bit_file, "extsize": args.extsize, "encoding": args.encoding }
+    settings = { k: getattr(args, k) for k in ("bed_file", "two_bit_file", "extsize", "coordinate_map", "random_access", "format", "encoding") }
+    settings.update(batch_size = batchsize)
+    with ExitStack() as stack:
+        checkpoint = resumable(args, stack, settings)
+        done = checkpoint.batches if checkpoint is not None else 0
+        f = stack.enter_context(BedReader(args.bed_file, batchsize, done * batchsize))
+        o = stack.enter_context(MatrixOutput(args, args.output_file, metadata, binary, numpy.uint8, checkpoint.states(0) if checkpoint is not None else None))
+        batches = METRICS.jobs(Parallel(n_jobs = args.j, return_as = "generator"), "sequence", sequences, (
+            (args.two_bit_file, batch.windows(args.extsize), args.extsize, args.cache_size << 20) for batch in f
+        ))
+        for regions, codes in batches:
+            o.write(regions, codes if binary and args.encoding == "codes" else onehotarray(codes))
+            if checkpoint is not None: checkpoint.record([ o.checkpoint() ])
 
 def runsequence_all(args):
-    with TwoBitReader(args.two_bit_file) as t:
-        with open(args.bed_file, 'r') as f:
-            if not args.coordinate_map:
-                results = [ t.read(*seqregion(x, args.extsize)) for x in f ]
-            else:
-                results = { "%s:%s-%s" % seqregion(x, args.extsize): t.read(*seqregion(x, args.extsize)) for x in f }
+    from joblib import Parallel, effective_n_jobs
+    regions = loadbed(args.bed_file).windows(args.extsize)
+    j = effective_n_jobs(args.j)
+    chunks = [ regions[len(regions) * i // j : len(regions) * (i + 1) // j] for i in range(j) ]
+    results = METRICS.jobs(
+        Parallel(n_jobs = args.j), "sequence", sequences, [ (args.two_bit_file, x, args.extsize, args.cache_size << 20) for x in chunks if len(x) > 0 ]
+    )
+    regions = flatten([ x for x, _ in results ])
+    values = flatten([ onehotarray(x).tolist() for _, x in results ])
+    if args.coordinate_map:
+        values = { "%s:%s-%s" % region: x for region, x in zip(regions, values) }
     with open(args.output_file, 'w') as o:
-        o.write(ujson.dumps(results) + '\n')
+        emit(o, encode(values) + '\n')
+    METRICS.count("rows_written", len(regions))
+
+def runmerge(args):
+    if not ismatrixfile(args.shards[0]):
+        from .aggregate import averages
+        names, sums, counts, metadata = mergepartials(args.shards)
+        values = averages(names, sums, counts, metadata["decimal_resolution"], metadata["grouped"])
+        values = { k: v.tolist() for k, v in values.items() } if metadata["grouped"] else values.tolist()
+        with open(args.output_file, 'w') as o:
+            emit(o, encode(values) + '\n')
+        return
+    with MatrixFileReader(args.shards[0]) as f:
+        metadata = { k: v for k, v in f.metadata.items() if k != "shard" }
+    with MatrixOutput(args, args.output_file, metadata, args.format == "binary") as o:
+        for regions, matrix in shardrows(args.shards, batch_size(args)):
+            o.write(regions, numpy.round(matrix, BIN_DECIMALS) if metadata["resolution"] > 1 else matrix)
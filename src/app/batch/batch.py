@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import queue
+import threading
+
 def batch_size(args):
     try:
         return args.batch_size
@@ -12,23 +15,46 @@ def flatten(l):
         r += x
     return r
 
-class BatchedFile:
-    
-    def __init__(self, file, batchsize):
-        self.file = file
-        self.batchsize = batchsize
-    
-    def __enter__(self):
-        self.handle = open(self.file, 'r')
-        return self
-    
-    def __iter__(self):
-        return self
-    
-    def __next__(self):
-        results = [ x for x in [ self.handle.readline().strip() for _ in range(self.batchsize) ] if len(x.strip().split()) >= 3 ]
-        if len(results) == 0: raise StopIteration
-        return results
+class PrefetchError:
+
+    def __init__(self, error):
+        self.error = error
 
-    def __exit__(self, *args):
-        self.handle.close()
+def prefetch(iterable, depth = 2):
+    """
+    Iterates over the given iterable in a background thread, keeping at most depth items ready ahead of the consumer, so
+    that producing item N + 1 overlaps with consuming item N while memory stays bounded. Items are yielded in order, and
+    exceptions raised by the iterable are re-raised in the consumer. If depth is 0 the iterable is consumed directly.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize = depth)
+    stop = threading.Event()
+    done = object()
+    def offer(x):
+        while not stop.is_set():
+            try:
+                items.put(x, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for x in iterable:
+                if not offer(x): return
+            offer(done)
+        except BaseException as e:
+            offer(PrefetchError(e))
+    producer = threading.Thread(target = produce, daemon = True)
+    producer.start()
+    try:
+        while True:
+            x = items.get()
+            if x is done: break
+            if isinstance(x, PrefetchError): raise x.error
+            yield x
+    finally:
+        stop.set()
+        producer.join()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import numpy
+
+MAX_SPAN = 1000000
+
+def sortorder(regions):
+    """
+    Orders regions by genomic position so that reads from the same part of a BigWig happen together.
+
+    Args:
+        regions (list): list of regions, each as a tuple of chromosome, start, end, strand or None
+
+    Returns:
+        An int64 array of indexes into the region list, sorted by chromosome then start position. Regions which
+        are None are omitted.
+    """
+    present = [ i for i, region in enumerate(regions) if region is not None ]
+    if len(present) == 0: return numpy.zeros(0, dtype = numpy.int64)
+    _, chroms = numpy.unique([ regions[i][0] for i in present ], return_inverse = True)
+    starts = numpy.array([ regions[i][1] for i in present ], dtype = numpy.int64)
+    return numpy.array(present, dtype = numpy.int64)[numpy.lexsort((starts, chroms))]
+
+def divide(regions, order, j):
+    """
+    Splits a sorted region list into at most j contiguous runs containing roughly equal numbers of basepairs.
+
+    Args:
+        regions (list): list of regions, each as a tuple of chromosome, start, end, strand
+        order (numpy.ndarray): indexes into the region list in the order they should be read, as from sortorder
+        j (int): number of jobs to divide the regions among
+
+    Returns:
+        A list of offsets into the order array at which each job starts, followed by the length of the order array.
+    """
+    if len(order) == 0: return [ 0 ]
+    widths = numpy.array([ max(regions[i][2] - regions[i][1], 1) for i in order ], dtype = numpy.int64)
+    cumulative = numpy.cumsum(widths)
+    targets = cumulative[-1] * numpy.arange(1, j) / j
+    divpoints = [ 0 ] + numpy.searchsorted(cumulative, targets, side = "right").tolist() + [ len(order) ]
+    return sorted(set(divpoints))
+
+def spans(regions, maxspan = MAX_SPAN):
+    """
+    Merges overlapping or adjacent regions into spans which can be read from a BigWig with a single request.
+
+    Args:
+        regions (list): list of regions, each as a tuple of chromosome, start, end, strand, sorted by position
+        maxspan (int): largest span to produce in basepairs; regions are not merged past this size
+
+    Yields:
+        Tuples of chromosome, start, end, and a list of indexes of the regions covered by the span.
+    """
+    current = None
+    for k, region in enumerate(regions):
+        chrom, start, end = region[:3]
+        if current is not None and chrom == current[0] and start <= current[2] and max(end, current[2]) - current[1] <= maxspan:
+            current[2] = max(end, current[2])
+            current[3].append(k)
+            continue
+        if current is not None: yield tuple(current)
+        current = [ chrom, start, end, [ k ] ]
+    if current is not None: yield tuple(current)
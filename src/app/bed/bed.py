@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import numpy
+from itertools import islice
+
+from ..metrics.metrics import METRICS
+
+HEADERS = ("#", "track", "browser")
+
+def openbed(path: str):
+    """
+    Opens a BED file for reading as text. Files compressed with gzip or bgzip are detected from their first bytes and
+    decompressed transparently, whatever their extension.
+    """
+    if not os.path.exists(path):
+        raise Exception("Error opening %s: no such file or directory." % path)
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, 'rt') if compressed else open(path, 'r')
+
+def records(handle):
+    """
+    Yields the whitespace-separated fields of each region in a BED file. Blank lines, header lines and lines with fewer
+    than three fields are skipped, and do not count towards region indexes.
+    """
+    for line in handle:
+        fields = line.split()
+        if len(fields) >= 3 and not fields[0].startswith(HEADERS): yield fields
+
+class BedRegions:
+    """
+    Columnar view of a list of BED regions. Chromosomes are stored as int32 codes into a list of chromosome names, and
+    start and end positions as int64 arrays. The fourth and fifth fields are kept as lists of strings, with None for
+    regions which have fewer fields.
+    """
+
+    def __init__(self, chromosomes, chroms, starts, ends, fourth, fifth):
+        self.chromosomes = chromosomes
+        self.chroms = chroms
+        self.starts = starts
+        self.ends = ends
+        self.fourth = fourth
+        self.fifth = fifth
+
+    @classmethod
+    def parse(cls, fields, chromosomes = None):
+        """
+        Builds a BedRegions from split BED lines.
+
+        Args:
+            fields (list): list of lists of fields, as from records
+            chromosomes (dict): chromosome name to code map, extended with any new chromosomes; pass the same map for every
+                batch of a file so that codes are consistent between batches
+        """
+        chromosomes = chromosomes if chromosomes is not None else {}
+        chroms = numpy.array([ chromosomes.setdefault(x[0], len(chromosomes)) for x in fields ], dtype = numpy.int32)
+        starts = numpy.array([ x[1] for x in fields ], dtype = numpy.int64)
+        ends = numpy.array([ x[2] for x in fields ], dtype = numpy.int64)
+        fourth = [ x[3] if len(x) > 3 else None for x in fields ]
+        fifth = [ x[4] if len(x) > 4 else None for x in fields ]
+        return cls(chromosomes, chroms, starts, ends, fourth, fifth)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return BedRegions(self.chromosomes, self.chroms[i], self.starts[i], self.ends[i], self.fourth[i], self.fifth[i])
+
+    def names(self):
+        """
+        Returns:
+            List of the chromosome name of each region.
+        """
+        names = numpy.empty(len(self.chromosomes), dtype = object)
+        for name, code in self.chromosomes.items(): names[code] = name
+        return names[self.chroms].tolist()
+
+    def midpoints(self):
+        return (self.starts + self.ends) // 2
+
+    def centers(self, strand = 3):
+        """
+        Returns:
+            List of center points as tuples of chromosome, midpoint and strand, which is read from the given field (3,
+            the fourth field, by default) and is '.' if the field is absent.
+        """
+        strands = self.fourth if strand == 3 else self.fifth
+        return [ (c, m, s if s is not None else '.') for c, m, s in zip(self.names(), self.midpoints().tolist(), strands) ]
+
+    def regions(self):
+        """
+        Returns:
+            List of complete regions as tuples of chromosome, start, end and the fourth field, or '.' if it is absent.
+        """
+        return [
+            (c, s, e, x if x is not None else '.') for c, s, e, x in zip(self.names(), self.starts.tolist(), self.ends.tolist(), self.fourth)
+        ]
+
+    def windows(self, extsize):
+        """
+        Returns:
+            List of regions extending extsize basepairs either side of each midpoint, as tuples of chromosome, start, end.
+        """
+        midpoints = self.midpoints()
+        return list(zip(self.names(), (midpoints - extsize).tolist(), (midpoints + extsize).tolist()))
+
+    def lines(self):
+        """
+        Returns:
+            List of the first four fields of each region, tab separated, as BED text without a trailing newline.
+        """
+        return [
+            "%s\t%d\t%d" % (c, s, e) + ("\t" + x if x is not None else "")
+            for c, s, e, x in zip(self.names(), self.starts.tolist(), self.ends.tolist(), self.fourth)
+        ]
+
+def loadbed(path: str, start: int = 0, end: int = None) -> BedRegions:
+    """
+    Reads a BED file, or the regions with indexes start (inclusive) to end (not inclusive) from it, into a BedRegions.
+    Regions before start are skipped without being stored. Negative indexes count from the end of the file, as for list
+    slices; in that case the whole file is read first.
+    """
+    if start < 0 or (end is not None and end < 0): return loadbed(path)[start:end]
+    with openbed(path) as f, METRICS.stage("parse"):
+        regions = BedRegions.parse(list(islice(records(f), start, end)))
+    METRICS.count("regions_read", len(regions))
+    return regions
+
+def bedrange(path: str, start: int = 0, end: int = None):
+    """
+    Resolves a range of region indexes in a BED file, which may count from the end of the file as for list slices, to
+    indexes counted from its start. The file is only read, without storing its regions, if an index is negative.
+
+    Returns:
+        Tuple of the first (inclusive) and last (not inclusive, or None for the end of the file) region index.
+    """
+    if start >= 0 and (end is None or end >= 0): return start, end
+    with openbed(path) as f:
+        count = sum(1 for _ in records(f))
+    return slice(start, end).indices(count)[:2]
+
+class BedReader:
+    """
+    Reads a BED file in batches of batchsize regions, each returned as a BedRegions. If start or end are given only regions
+    with indexes in that range are returned; regions before start are skipped without being stored. Negative indexes
+    count from the end of the file, as for loadbed.
+    """
+
+    def __init__(self, path: str, batchsize: int = 1000, start: int = 0, end: int = None):
+        self.path = path
+        self.batchsize = batchsize
+        self.start = start
+        self.end = end
+        self.chromosomes = {}
+
+    def __enter__(self):
+        start, end = bedrange(self.path, self.start, self.end)
+        self.handle = openbed(self.path)
+        self.records = islice(records(self.handle), start, end)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with METRICS.stage("parse"):
+            batch = list(islice(self.records, self.batchsize))
+            if len(batch) == 0: raise StopIteration
+            regions = BedRegions.parse(batch, self.chromosomes)
+        METRICS.count("regions_read", len(regions))
+        return regions
+
+    def __exit__(self, *args):
+        self.handle.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import hashlib
+import tempfile
+import ujson
+import numpy
+
+HEADER_BYTES = 1 << 16
+
+class MatrixCache:
+    """
+    Content-addressed on-disk cache of extracted signal matrices. Each entry is the raw float32 basepair matrix for one set
+    of regions read from one BigWig, stored as a .npy file named for the hash of the BigWig's identity, the regions and the
+    matrix width, so results are reused whatever resolution or rounding is later applied to them. Entries are returned
+    memory-mapped. When the cache grows past maxsize bytes the least recently used entries are deleted. The size of the
+    cache is tracked as entries are added, so the directory is only scanned when the cache is first written to and when
+    it grows past maxsize.
+    """
+
+    def __init__(self, directory: str, maxsize: int):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.sizes = None
+        self.total = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, bigwig: str, regions, width: int) -> str:
+        """
+        Returns:
+            Hex digest identifying the matrix for the given regions, as tuples of chromosome, start, end, strand or None,
+            read from the given BigWig. The BigWig is identified by its path, size, modification time and a hash of its
+            header.
+        """
+        digest = hashlib.sha256()
+        stat = os.stat(bigwig)
+        with open(bigwig, 'rb') as f:
+            digest.update(f.read(HEADER_BYTES))
+        digest.update(ujson.dumps([ os.path.realpath(bigwig), stat.st_size, stat.st_mtime_ns, width ]).encode())
+        for i in range(0, len(regions), 100000):
+            digest.update(ujson.dumps([ list(x) if x is not None else None for x in regions[i : i + 100000] ]).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key: str):
+        """
+        Returns:
+            The cached matrix, memory-mapped read-only, or None if it is not cached.
+        """
+        try:
+            matrix = numpy.load(self.path(key), mmap_mode = 'r')
+            os.utime(self.path(key))
+            return matrix
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, matrix):
+        """
+        Adds a matrix to the cache, then evicts entries until the cache fits in maxsize. Matrices larger than maxsize are
+        not cached.
+        """
+        matrix = numpy.asarray(matrix, dtype = numpy.float32)
+        if matrix.nbytes > self.maxsize: return
+        handle, temporary = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+        try:
+            with os.fdopen(handle, 'wb') as o:
+                numpy.save(o, matrix)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            if os.path.exists(temporary): os.remove(temporary)
+            raise
+        if self.sizes is None:
+            self.scan()
+        else:
+            size = os.path.getsize(self.path(key))
+            self.total += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+        if self.total > self.maxsize: self.evict()
+
+    def scan(self):
+        """
+        Reads the size and last use time of every entry in the cache directory, which other runs may also have changed.
+
+        Returns:
+            List of tuples of last use time, size and key for each entry.
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.npy")):
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.basename(path)[:-len(".npy")]))
+            except OSError:
+                pass
+        self.sizes = { key: size for _, size, key in entries }
+        self.total = sum(self.sizes.values())
+        return entries
+
+    def evict(self):
+        for _, size, key in sorted(self.scan()):
+            if self.total <= self.maxsize: break
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.total -= size
+            del self.sizes[key]
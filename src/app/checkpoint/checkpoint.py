@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import ujson
+
+def sync(handle):
+    """
+    Flushes a file to disk, so that what has been written to it survives the process being killed.
+    """
+    handle.flush()
+    os.fsync(handle.fileno())
+
+class Checkpoint:
+    """
+    Records the progress of a streaming run in a sidecar file, so that an interrupted run can continue where it stopped.
+    The first line of the file holds the run's settings, and each further line the state of every output after one
+    completed batch. A batch is only recorded once its output has been flushed to disk, so anything written to an
+    output after its last recorded state belongs to a batch which did not finish, and is discarded on resume. If the
+    file already exists when the checkpoint is opened its recorded batches are loaded; the file is removed when the
+    checkpoint is closed without an error.
+    """
+
+    def __init__(self, path: str, settings: dict):
+        self.path = path
+        self.settings = ujson.loads(ujson.dumps(settings))
+        self.entries = []
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a+')
+        self.handle.seek(0)
+        lines = self.handle.readlines()
+        if len(lines) == 0 or not lines[0].endswith('\n'):
+            self.handle.truncate(0)
+            self.handle.write(ujson.dumps(self.settings) + '\n')
+            sync(self.handle)
+            return self
+        if ujson.loads(lines[0]) != self.settings:
+            self.handle.close()
+            raise Exception("Error resuming from %s: the checkpoint was written by a run with different arguments." % self.path)
+        size = len(lines[0])
+        for line in lines[1:]:
+            if not line.endswith('\n'): break
+            self.entries.append(ujson.loads(line))
+            size += len(line)
+        self.handle.truncate(size)
+        return self
+
+    @property
+    def batches(self):
+        """
+        Number of batches completed by earlier runs.
+        """
+        return len(self.entries)
+
+    def states(self, i: int):
+        """
+        Returns:
+            List of the states recorded for output i, one for each completed batch.
+        """
+        return [ x[i] for x in self.entries ]
+
+    def record(self, states):
+        """
+        Records a completed batch.
+
+        Args:
+            states (list): state of each output after the batch, which must already be flushed to disk
+        """
+        self.handle.write(ujson.dumps(states) + '\n')
+        sync(self.handle)
+
+    def __exit__(self, *args):
+        self.handle.close()
+        if args[0] is None: os.remove(self.path)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+from joblib import Parallel, delayed
+
+from .aggregate import openbigwig, aggregate, groupedsums, regionstats
+
+def initialize(bigwigs):
+    """
+    Worker initializer: opens the BigWigs in the calling process so that later reads reuse the handles.
+    """
+    for bigwig in bigwigs: openbigwig(bigwig)
+
+class ExtractionEngine:
+    """
+    Long-lived signal extraction engine for BigWig files. The engine owns a pool of j worker processes which is kept
+    alive until the engine is closed; when the engine is opened each worker opens the BigWigs, and workers keep their handles
+    for the lifetime of the pool. Batches submitted to the engine therefore pay neither pool startup nor file opening costs,
+    and results are returned in submission order. If a cache.MatrixCache is passed, signal matrices are read from and added
+    to it. An engine may serve several BigWigs, given as a list, from the same pool; aggregate reads from the first unless
+    another is named.
+    """
+
+    def __init__(self, bigwig, j: int = 8, cache = None):
+        self.bigwigs = [ bigwig ] if isinstance(bigwig, str) else list(bigwig)
+        self.bigwig = self.bigwigs[0]
+        self.j = j
+        self.cache = cache
+
+    def __enter__(self):
+        initialize(self.bigwigs)
+        self.parallel = Parallel(n_jobs = self.j)
+        self.parallel.__enter__()
+        if self.j != 1: self.parallel(delayed(initialize)(self.bigwigs) for _ in range(self.j))
+        return self
+
+    def __exit__(self, *args):
+        self.parallel.__exit__(*args)
+
+    def aggregate(
+        self, centers, extsize, startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, noextension = False, shared_memory = False,
+        bigwig = None, summary = "bases"
+    ):
+        """
+        Aggregates signal around a batch of center points from the given BigWig, or the engine's first; see aggregate.aggregate.
+        """
+        return aggregate(
+            bigwig if bigwig is not None else self.bigwig, centers, extsize, self.j, startindex, endindex, resolution, decimal_resolution, noextension, shared_memory, self.parallel,
+            self.cache, summary
+        )
+
+    def sums(self, centers, groups, extsize, resolution = 1, bigwig = None, summary = "bases"):
+        """
+        Sums binned signal around a batch of center points by group from the given BigWig, or the engine's first; see
+        aggregate.groupedsums.
+        """
+        return groupedsums(bigwig if bigwig is not None else self.bigwig, centers, groups, extsize, self.j, resolution, self.parallel, summary)
+
+    def stats(self, centers, extsize, stat = "sum", exact = True, noextension = False, intervals = False):
+        """
+        Computes a summary statistic of the signal around each of a batch of center points; see aggregate.regionstats.
+        """
+        return regionstats(self.bigwig, centers, extsize, self.j, stat, exact, noextension, self.parallel, intervals)
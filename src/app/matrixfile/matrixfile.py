@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import struct
+import ujson
+import numpy
+
+MAGIC = b"SIGMTX02"
+TRAILER = struct.Struct("<Q8s")
+# coordinates of one row: index into the footer's chromosome list, start and end
+REGION = numpy.dtype([ ("chrom", "<i4"), ("start", "<i8"), ("end", "<i8") ])
+
+# number of decimal places binned matrix values are rounded to, whatever --decimal-resolution is
+BIN_DECIMALS = 2
+
+class MatrixFileWriter:
+    """
+    Writes a binary matrix file in a single pass. Rows are fixed-width arrays of a single little-endian dtype, written
+    back to back immediately after an eight byte magic number, so row i starts at byte 8 + i * row_bytes. Row region
+    coordinates are written as they arrive to a fixed-width sidecar file, path + ".regions", so that they are never all
+    held in memory. When the writer is closed the coordinates are copied after the rows as a block of REGION records, and
+    a JSON footer is appended recording the dtype, shape, byte offsets, the chromosome names the coordinates refer to and
+    any caller-supplied metadata, followed by the footer length and the magic number again. If the writer is closed by
+    an error neither the coordinates nor the footer are written, and the sidecar file is kept for resume.
+    """
+
+    def __init__(self, path: str, dtype = numpy.float32, metadata = None):
+        self.path = path
+        self.regionspath = path + ".regions"
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.metadata = metadata if metadata is not None else {}
+        self.rowshape = None
+        self.rows = 0
+        self.regions = 0
+        self.chromosomes = {}
+
+    def __enter__(self):
+        self.handle = open(self.path, 'wb')
+        self.handle.write(MAGIC)
+        self.regionhandle = open(self.regionspath, 'wb')
+        return self
+
+    def resume(self, rows: int, rowshape, regions: int, chromosomes, offset: int):
+        """
+        Opens a partly written file in place of __enter__, to continue writing after its first rows rows. Anything
+        written after those rows, which end at byte offset, and after their coordinates in the sidecar file, is discarded.
+
+        Args:
+            rows (int): number of rows to keep
+            rowshape (list): shape of each row, or None if no rows have been written
+            regions (int): number of row coordinates to keep
+            chromosomes (list): chromosome names the kept coordinates refer to, in the order they were first written
+            offset (int): byte offset of the end of the rows kept
+        """
+        self.handle = open(self.path, 'r+b')
+        self.handle.truncate(offset)
+        self.handle.seek(offset)
+        self.regionhandle = open(self.regionspath, 'r+b' if regions > 0 else 'wb')
+        self.regionhandle.truncate(regions * REGION.itemsize)
+        self.regionhandle.seek(regions * REGION.itemsize)
+        self.rows = rows
+        self.rowshape = tuple(rowshape) if rowshape is not None else None
+        self.regions = regions
+        self.chromosomes = { x: i for i, x in enumerate(chromosomes) }
+        return self
+
+    def write(self, rows, regions = None):
+        """
+        Appends rows to the file.
+
+        Args:
+            rows (numpy.ndarray): array whose first dimension indexes rows; all rows in a file must have the same shape
+            regions (list): optional coordinates for each row, as tuples of chromosome, start, end
+        """
+        rows = numpy.asarray(rows)
+        if self.rowshape is None: self.rowshape = rows.shape[1:]
+        if rows.shape[1:] != self.rowshape:
+            raise ValueError("row shape %s does not match previous rows with shape %s" % (rows.shape[1:], self.rowshape))
+        self.handle.write(numpy.ascontiguousarray(rows, dtype = self.dtype).tobytes())
+        self.rows += rows.shape[0]
+        if regions is not None:
+            records = numpy.empty(len(regions), dtype = REGION)
+            records["chrom"] = [ self.chromosomes.setdefault(c, len(self.chromosomes)) for c, _, _ in regions ]
+            records["start"] = [ s for _, s, _ in regions ]
+            records["end"] = [ e for _, _, e in regions ]
+            self.regionhandle.write(records.tobytes())
+            self.regions += len(regions)
+
+    def footer(self, regionsoffset):
+        return {
+            "dtype": self.dtype.str,
+            "shape": [ self.rows ] + list(self.rowshape if self.rowshape is not None else ()),
+            "data_offset": len(MAGIC),
+            "row_bytes": int(numpy.prod(self.rowshape if self.rowshape is not None else ())) * self.dtype.itemsize,
+            "regions": { "offset": regionsoffset, "chromosomes": list(self.chromosomes) } if regionsoffset is not None else None,
+            "metadata": self.metadata
+        }
+
+    def __exit__(self, *args):
+        try:
+            if args[0] is not None: return
+            regionsoffset = None
+            if self.regions == self.rows:
+                regionsoffset = self.handle.tell()
+                self.regionhandle.flush()
+                with open(self.regionspath, 'rb') as f:
+                    shutil.copyfileobj(f, self.handle, 1 << 20)
+            footer = ujson.dumps(self.footer(regionsoffset)).encode()
+            self.handle.write(footer)
+            self.handle.write(TRAILER.pack(len(footer), MAGIC))
+        finally:
+            self.handle.close()
+            self.regionhandle.close()
+        os.remove(self.regionspath)
+
+class RegionBlock:
+    """
+    Row region coordinates of a binary matrix file, read on demand from its block of REGION records. Supports len(),
+    integer indexing (returning one region as a list of chromosome, start, end) and slicing (returning a list of regions).
+    """
+
+    def __init__(self, handle, offset: int, count: int, chromosomes):
+        self.handle = handle
+        self.offset = offset
+        self.count = count
+        self.chromosomes = chromosomes
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            indexes = range(self.count)[i]
+            if len(indexes) == 0: return []
+            first = min(indexes[0], indexes[-1])
+            records = self.records(first, abs(indexes[-1] - indexes[0]) + 1)[numpy.array(indexes) - first]
+            return [ [ self.chromosomes[c], s, e ] for c, s, e in records.tolist() ]
+        if i < 0: i += self.count
+        if i < 0 or i >= self.count: raise IndexError("region index out of range")
+        c, s, e = self.records(i, 1).tolist()[0]
+        return [ self.chromosomes[c], s, e ]
+
+    def records(self, start, count):
+        self.handle.seek(self.offset + start * REGION.itemsize)
+        return numpy.frombuffer(self.handle.read(count * REGION.itemsize), dtype = REGION)
+
+class MatrixFileReader:
+    """
+    Reads rows from a binary matrix file written by MatrixFileWriter without reading the rest of the file. Supports
+    len(), integer indexing (returning one row) and slicing (returning a matrix of rows). Row coordinates, if the file has
+    them, are read on demand through the regions attribute, a RegionBlock; otherwise regions is None.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self):
+        self.handle = open(self.path, 'rb')
+        if self.handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary matrix file" % self.path)
+        self.handle.seek(-TRAILER.size, 2)
+        length, magic = TRAILER.unpack(self.handle.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is truncated or incomplete" % self.path)
+        self.handle.seek(-TRAILER.size - length, 2)
+        footer = ujson.loads(self.handle.read(length))
+        self.dtype = numpy.dtype(footer["dtype"])
+        self.shape = tuple(footer["shape"])
+        self.offset = footer["data_offset"]
+        self.rowbytes = footer["row_bytes"]
+        regions = footer["regions"]
+        self.regions = RegionBlock(self.handle, regions["offset"], self.shape[0], regions["chromosomes"]) if regions is not None else None
+        self.metadata = footer["metadata"]
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            rows = range(len(self))[i]
+            if len(rows) == 0: return self.rowblock(0, 0)
+            first = min(rows[0], rows[-1])
+            block = self.rowblock(first, abs(rows[-1] - rows[0]) + 1)
+            return block if rows.step == 1 else block[numpy.array(rows) - first]
+        if i < 0: i += len(self)
+        if i < 0 or i >= len(self): raise IndexError("row index out of range")
+        return self.rowblock(i, 1)[0]
+
+    def rowblock(self, start, count):
+        self.handle.seek(self.offset + start * self.rowbytes)
+        data = self.handle.read(count * self.rowbytes)
+        return numpy.frombuffer(data, dtype = self.dtype).reshape((count,) + self.shape[1:])
+
+    def array(self):
+        """
+        Returns:
+            The complete matrix as a read-only memory-mapped array.
+        """
+        if len(self) == 0: return numpy.zeros(self.shape, dtype = self.dtype)
+        return numpy.memmap(self.path, dtype = self.dtype, mode = 'r', offset = self.offset, shape = self.shape)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+def timed(function, *args):
+    """
+    Calls a function, timing it. Intended to be called in Parallel in place of the function itself.
+
+    Returns:
+        Tuple of the function's result, and the wall clock and CPU seconds it took in the worker.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+class Metrics:
+    """
+    Records per-stage wall clock and CPU time, counters and worker utilization for a run. Recording is off until enable is
+    called, and costs nothing while off. Stages timed in the main process are recorded with stage; work done in worker
+    processes is timed in the worker and recorded through jobs. If progress is enabled, counter updates print a progress
+    line to stderr at most every interval seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.progress = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.workers = {}
+        self.started = time.perf_counter()
+        self.cpu = time.process_time()
+        self.reported = self.started
+
+    def enable(self, progress = False, interval = 10.0):
+        self.reset()
+        self.enabled = True
+        self.progress = progress
+        self.interval = interval
+
+    def disable(self):
+        self.enabled = False
+        self.progress = False
+
+    def record(self, name, wall, cpu, calls = 1):
+        with self.lock:
+            stage = self.stages.setdefault(name, { "wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0 })
+            stage["wall_seconds"] += wall
+            stage["cpu_seconds"] += cpu
+            stage["calls"] += calls
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as the named stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def count(self, name, n = 1):
+        """
+        Adds n to the named counter, printing progress if it is due.
+        """
+        if not self.enabled: return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            due = self.progress and time.perf_counter() - self.reported >= self.interval
+            if due: self.reported = time.perf_counter()
+        if due: print(self.status(), file = sys.stderr)
+
+    def jobs(self, parallel, stage, function, arguments):
+        """
+        Runs function once for each tuple of arguments on the given joblib Parallel. When enabled, each call is timed in its
+        worker as the named stage, and the time the main process waits for the calls is recorded to measure utilization.
+
+        Returns:
+            The results of the calls, as a list, or as a generator if the Parallel returns a generator.
+        """
+        # joblib is already loaded by whoever built the Parallel; importing it here keeps it out of commands which never run jobs
+        from joblib import delayed
+        if not self.enabled: return parallel(delayed(function)(*x) for x in arguments)
+        start = time.perf_counter()
+        results = parallel(delayed(timed)(function, *x) for x in arguments)
+        if isinstance(results, list):
+            self.utilization(stage, results, time.perf_counter() - start, parallel)
+            return [ x for x, _, _ in results ]
+        return self.unwrap(stage, results, start, parallel)
+
+    def unwrap(self, stage, results, start, parallel):
+        done = []
+        try:
+            for x in results:
+                done.append(x[1:])
+                yield x[0]
+        finally:
+            self.utilization(stage, [ (None,) + x for x in done ], time.perf_counter() - start, parallel)
+
+    def utilization(self, stage, results, elapsed, parallel):
+        from joblib import effective_n_jobs
+        for _, wall, cpu in results:
+            self.record(stage, wall, cpu)
+        workers = self.workers.setdefault(stage, { "busy_seconds": 0.0, "capacity_seconds": 0.0 })
+        workers["busy_seconds"] += sum([ wall for _, wall, _ in results ])
+        workers["capacity_seconds"] += elapsed * effective_n_jobs(parallel.n_jobs)
+
+    def status(self):
+        elapsed = time.perf_counter() - self.started
+        return "%.0fs elapsed: %s" % (elapsed, ", ".join([ "%d %s" % (v, k.replace('_', ' ')) for k, v in self.counters.items() ]))
+
+    def report(self):
+        """
+        Returns:
+            Dictionary with the total wall clock and CPU time, peak memory, stage times, counters, and for each stage run on
+            workers the fraction of worker time spent busy.
+        """
+        return {
+            "wall_seconds": time.perf_counter() - self.started,
+            "cpu_seconds": time.process_time() - self.cpu,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            "stages": self.stages,
+            "counters": self.counters,
+            "workers": {
+                k: dict(v, utilization = v["busy_seconds"] / v["capacity_seconds"] if v["capacity_seconds"] > 0 else 0.0)
+                for k, v in self.workers.items()
+            }
+        }
+
+    def summary(self):
+        """
+        Returns:
+            The report as a human readable table.
+        """
+        report = self.report()
+        lines = [ "%-24s %10s %10s %8s" % ("stage", "wall (s)", "cpu (s)", "calls") ]
+        for name, stage in sorted(report["stages"].items(), key = lambda x: -x[1]["wall_seconds"]):
+            lines.append("%-24s %10.3f %10.3f %8d" % (name, stage["wall_seconds"], stage["cpu_seconds"], stage["calls"]))
+        for name, workers in report["workers"].items():
+            lines.append("%s worker utilization: %.0f%%" % (name, workers["utilization"] * 100))
+        lines.append("total: %.3fs wall, %.3fs cpu, %.1f MB peak RSS; %s" % (
+            report["wall_seconds"], report["cpu_seconds"], report["peak_rss_bytes"] / (1 << 20), self.status()
+        ))
+        return "\n".join(lines)
+
+METRICS = Metrics()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from typing import List
+import numpy
 
 ONEHOT = {
     'a': [ 1, 0, 0, 0 ],
@@ -10,7 +10,21 @@ ONEHOT = {
     'n': [ 0, 0, 0, 0 ]
 }
 
-def onehot(sequence: str) -> List[int]:
-    return [
-        ONEHOT[x.lower()] for x in sequence.replace(" ", "")
-    ]
+N = 4
+CODES = numpy.full(256, N, dtype = numpy.uint8)
+for i, base in enumerate("acgt"):
+    CODES[ord(base)] = CODES[ord(base.upper())] = i
+ONEHOT_ARRAY = numpy.array([ ONEHOT[x] for x in "acgtn" ], dtype = numpy.uint8)
+
+def encode(sequence: str) -> numpy.ndarray:
+    """
+    Converts a sequence to a vector of base codes through a lookup table over its raw bytes: 0, 1, 2 and 3 for A, C, G
+    and T, in either case, and 4 (N) for anything else.
+    """
+    return CODES[numpy.frombuffer(sequence.replace(" ", "").encode("ascii"), dtype = numpy.uint8)]
+
+def onehotarray(codes: numpy.ndarray) -> numpy.ndarray:
+    """
+    Expands a vector of base codes from encode into an L x 4 uint8 one hot matrix; N is encoded as all zeroes.
+    """
+    return ONEHOT_ARRAY[codes]
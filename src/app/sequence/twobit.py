@@ -1,30 +1,118 @@
 #!/usr/bin/env python3
 
-import twobitreader
+import mmap
+import struct
+import numpy
+from collections import OrderedDict
 from typing import List
 
-from .onehot import onehot, ONEHOT
+from .onehot import N, encode, onehotarray
 
-class TwoBitReader:
+SIGNATURE = 0x1A412743
+
+# 2bit packs T, C, A, G as 0, 1, 2, 3; map them to the base codes used by encode
+TWOBIT_CODES = encode("TCAG")
+SHIFTS = numpy.array([ 6, 4, 2, 0 ], dtype = numpy.uint8)
+
+READERS = {}
 
-    @staticmethod
-    def pad(a, l):
-        return a + [ ONEHOT['n'] for _ in range(l - len(a)) ]
+def reader(path: str, cache: int = 0):
+    """
+    Returns an open TwoBitReader for the given path which is shared by every caller in this process, so that worker
+    processes parse each file's index, and fill its chromosome cache, only once.
+    """
+    if (path, cache) not in READERS:
+        READERS[(path, cache)] = TwoBitReader(path, cache).__enter__()
+    return READERS[(path, cache)]
 
-    def __init__(self, path: str):
+class TwoBitReader:
+    """
+    Reads sequence from a memory-mapped 2bit file. The header and sequence index are parsed when the file is opened;
+    each chromosome's N block and mask records are parsed the first time it is read. Slices are decoded directly from
+    the mapped bytes. If cache is greater than zero, decoded chromosomes are kept in a least recently used cache holding
+    at most that many bytes, which helps workloads that read the same chromosomes repeatedly; chromosomes larger than
+    the cache are always decoded slice by slice.
+    """
+
+    def __init__(self, path: str, cache: int = 0):
         self.path = path
-    
+        self.cachesize = cache
+        self.cache = OrderedDict()
+        self.cached = 0
+        self.records = {}
+
     def __enter__(self):
-        self.twobit = twobitreader.TwoBitFile(self.path)
+        self.handle = open(self.path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ)
+        self.endian = '<' if struct.unpack('<I', self.data[:4])[0] == SIGNATURE else '>'
+        signature, version, count, _ = struct.unpack(self.endian + 'IIII', self.data[:16])
+        if signature != SIGNATURE:
+            raise Exception("Error opening %s: not a 2bit file." % self.path)
+        offsetformat = self.endian + ('Q' if version == 1 else 'I')
+        self.index, position = {}, 16
+        for _ in range(count):
+            size = self.data[position]
+            name = self.data[position + 1 : position + 1 + size].decode()
+            position += 1 + size
+            self.index[name] = struct.unpack_from(offsetformat, self.data, position)[0]
+            position += struct.calcsize(offsetformat)
         return self
-    
+
     def __exit__(self, *args):
-        self.twobit.close()
-
-    def read(self, chromosome: str, start: int, end: int) -> List[int]:
-        try:
-            if start < 0:
-                return [ ONEHOT['n'] for _ in range(start, 0) ] + onehot(self.twobit[chromosome][:end])
-            return TwoBitReader.pad( onehot(self.twobit[chromosome][start:end]), end - start )
-        except:
-            return [ ONEHOT['n'] for _ in range(end - start) ]
+        self.cache.clear()
+        self.data.close()
+        self.handle.close()
+
+    def record(self, chromosome: str):
+        """
+        Returns:
+            Tuple of the chromosome length, start and end positions of its N blocks, and offset of its packed sequence.
+        """
+        if chromosome in self.records: return self.records[chromosome]
+        position = self.index[chromosome]
+        size, blocks = struct.unpack_from(self.endian + 'II', self.data, position)
+        nblocks = numpy.frombuffer(self.data, dtype = self.endian + 'u4', count = blocks * 2, offset = position + 8).astype(numpy.int64)
+        position += 8 + blocks * 8
+        masks = struct.unpack_from(self.endian + 'I', self.data, position)[0]
+        position += 4 + masks * 8 + 4
+        self.records[chromosome] = size, nblocks[:blocks], nblocks[:blocks] + nblocks[blocks:], position
+        return self.records[chromosome]
+
+    def decode(self, chromosome: str, start: int, end: int) -> numpy.ndarray:
+        size, nstarts, nends, offset = self.record(chromosome)
+        start, end = max(start, 0), min(end, size)
+        if end <= start: return numpy.zeros(0, dtype = numpy.uint8)
+        packed = numpy.frombuffer(self.data, dtype = numpy.uint8, count = (end + 3) // 4 - start // 4, offset = offset + start // 4)
+        codes = TWOBIT_CODES[((packed[:, None] >> SHIFTS) & 3).ravel()][start % 4 : start % 4 + end - start]
+        for i in range(numpy.searchsorted(nends, start, side = "right"), numpy.searchsorted(nstarts, end)):
+            codes[max(nstarts[i] - start, 0) : nends[i] - start] = N
+        return codes
+
+    def chromosome(self, chromosome: str) -> numpy.ndarray:
+        if chromosome in self.cache:
+            self.cache.move_to_end(chromosome)
+            return self.cache[chromosome]
+        codes = self.decode(chromosome, 0, self.record(chromosome)[0])
+        self.cache[chromosome] = codes
+        self.cached += len(codes)
+        while self.cached > self.cachesize:
+            self.cached -= len(self.cache.popitem(last = False)[1])
+        return codes
+
+    def codes(self, chromosome: str, start: int, end: int) -> numpy.ndarray:
+        """
+        Reads a region as a uint8 vector of base codes (see onehot.encode). Positions outside the chromosome, and
+        chromosomes missing from the file, are N.
+        """
+        result = numpy.full(max(end - start, 0), N, dtype = numpy.uint8)
+        if chromosome not in self.index or end <= max(start, 0): return result
+        if self.record(chromosome)[0] <= self.cachesize:
+            sequence = self.chromosome(chromosome)[max(start, 0):end]
+        else:
+            sequence = self.decode(chromosome, start, end)
+        result[max(-start, 0) : max(-start, 0) + len(sequence)] = sequence
+        return result
+
+    def read(self, chromosome: str, start: int, end: int, array: bool = False) -> List[int]:
+        values = onehotarray(self.codes(chromosome, start, end))
+        return values if array else values.tolist()
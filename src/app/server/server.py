@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import os
+import asyncio
+import ujson
+import numpy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ..aggregate import BIGWIGS, openbigwig, aggregate, regionstats
+from ..bed.bed import BedRegions
+from ..sequence.twobit import READERS, reader
+from ..sequence.onehot import onehotarray
+from ..app import sequences, zscores
+from ..metrics.metrics import METRICS
+
+DEFAULTS = {
+    "aggregate": { "extsize": 500, "resolution": 1, "decimal_resolution": 2, "summary": "bases", "grouped": False },
+    "matrix": { "extsize": 500, "resolution": 1, "summary": "bases", "coordinate_map": False },
+    "sequence": { "extsize": 500, "coordinate_map": False },
+    "zscore": { "extsize": None, "stat": "sum", "approximate": False, "intervals": False }
+}
+
+# request line length allowed for each region of the largest batch, and for the rest of the request
+REGION_BYTES = 256
+REQUEST_BYTES = 1 << 16
+
+class HandlePool:
+    """
+    Keeps at most size BigWig and 2bit files open in the current process, closing the least recently used file when
+    another is opened. Files are opened through aggregate.openbigwig and twobit.reader, so every read in the process
+    shares the pool's handles.
+    """
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self.files = OrderedDict()
+
+    def bigwig(self, path: str):
+        self.touch(("bigwig", path))
+        return openbigwig(path)
+
+    def twobit(self, path: str):
+        self.touch(("twobit", path))
+        return reader(path)
+
+    def touch(self, key):
+        if key in self.files:
+            self.files.move_to_end(key)
+            return
+        self.files[key] = True
+        while len(self.files) > self.size:
+            kind, path = self.files.popitem(last = False)[0]
+            if kind == "bigwig" and path in BIGWIGS: BIGWIGS.pop(path).close()
+            if kind == "twobit" and (path, 0) in READERS: READERS.pop((path, 0)).__exit__()
+
+    def close(self):
+        for kind, path in list(self.files):
+            if kind == "bigwig" and path in BIGWIGS: BIGWIGS.pop(path).close()
+            if kind == "twobit" and (path, 0) in READERS: READERS.pop((path, 0)).__exit__()
+        self.files.clear()
+
+def parse(message):
+    """
+    Validates a request and fills in defaults for its options.
+
+    Returns:
+        Tuple of the request's options, its regions as a BedRegions, the key shared by requests whose regions can be
+        extracted together, and the items to extract for each of its regions.
+    """
+    command = message.get("command")
+    if command not in DEFAULTS:
+        raise Exception("Error: unknown command %s; expected one of %s." % (command, ", ".join(DEFAULTS)))
+    options = dict(DEFAULTS[command], **{ k: v for k, v in message.items() if k in DEFAULTS[command] })
+    path = message.get("two_bit_file" if command == "sequence" else "signal_file")
+    if not isinstance(path, str):
+        raise Exception("Error: %s requests need a %s." % (command, "two_bit_file" if command == "sequence" else "signal_file"))
+    regions = BedRegions.parse([ x.split() if isinstance(x, str) else [ str(f) for f in x ] for x in message.get("regions", []) ])
+    if command == "sequence":
+        return options, regions, ("sequence", path, options["extsize"]), regions.windows(options["extsize"])
+    if command == "zscore":
+        items = regions.centers() if options["extsize"] is not None else regions.regions()
+        return options, regions, ("stats", path, options["extsize"], options["stat"], options["approximate"], options["intervals"]), items
+    items = regions.centers(4 if options.get("grouped") else 3)
+    return options, regions, ("signal", path, options["extsize"], options["resolution"], options["summary"]), items
+
+def extract(pool, key, items):
+    """
+    Extracts a batch of regions gathered from any number of requests which share a key, as from parse.
+
+    Returns:
+        A matrix or vector with one row per item: binned signal, base codes or summary statistics.
+    """
+    kind, path = key[:2]
+    if kind == "sequence":
+        pool.twobit(path)
+        return sequences(path, items, key[2])[1]
+    pool.bigwig(path)
+    if kind == "stats":
+        _, extsize, stat, approximate, intervals = key[1:]
+        return regionstats(path, items, extsize, 1, stat, not approximate, extsize is None, intervals = intervals)
+    _, extsize, resolution, summary = key[1:]
+    return aggregate(path, items, extsize, 1, 0, None, resolution, summary = summary)[1]
+
+def respond(command, options, regions, values):
+    """
+    Returns:
+        The result of a request, as the corresponding subcommand would write it, from the extracted rows for its regions.
+    """
+    if command == "aggregate":
+        if not options["grouped"]:
+            return numpy.round(values.mean(axis = 0, dtype = numpy.float64), options["decimal_resolution"]).tolist() if len(values) > 0 else []
+        names = {}
+        groups = numpy.array([ names.setdefault(x, len(names)) for x in regions.fourth ], dtype = numpy.int64)
+        return {
+            k: numpy.round(values[groups == i].mean(axis = 0, dtype = numpy.float64), options["decimal_resolution"]).tolist() for k, i in names.items()
+        }
+    if command == "zscore":
+        scores, present, minv = zscores(values)
+        return [ x if p else minv for x, p in zip(scores.tolist(), present.tolist()) ]
+    if command == "sequence":
+        values = onehotarray(values)
+        windows = regions.windows(options["extsize"])
+    else:
+        windows = [ (c, x - options["extsize"], x + options["extsize"]) for c, x, _ in regions.centers() ]
+    if options["coordinate_map"]: return { "%s:%d-%d" % region: x for region, x in zip(windows, values.tolist()) }
+    return values.tolist()
+
+class SignalServer:
+    """
+    Long-running server answering aggregate, matrix, sequence and zscore requests, so that callers with small region
+    lists pay neither startup nor file opening costs. Requests and responses are JSON objects, one per line, over a Unix
+    socket or a TCP port; several requests may be sent on one connection without waiting, and responses carry the
+    request's id. A request names its command, file (signal_file, or two_bit_file for sequence) and regions, as BED lines
+    or lists of BED fields, and may set the options of the corresponding subcommand, such as extsize and resolution.
+
+    Requests which read the same file with the same settings and arrive within window seconds of each other are
+    extracted together as one batch of at most maxregions regions. Extraction runs on a single thread, which owns a
+    HandlePool of at most maxopen open files. Request lines may be up to REGION_BYTES per region of a full batch long;
+    longer requests are answered with an error.
+    """
+
+    def __init__(self, window: float = 0.005, maxregions: int = 10000, maxopen: int = 64):
+        self.window = window
+        self.maxregions = maxregions
+        self.limit = REQUEST_BYTES + maxregions * REGION_BYTES
+        self.pool = HandlePool(maxopen)
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.pending = {}
+        self.tasks = set()
+        self.batches = 0
+
+    def submit(self, key, items):
+        """
+        Adds a request's items to the pending batch for its key.
+
+        Returns:
+            A future for the extracted rows of those items.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if key not in self.pending:
+            self.pending[key] = ([], loop.call_later(self.window, self.flush, key))
+        batch, _ = self.pending[key]
+        batch.append((items, future))
+        if sum([ len(x) for x, _ in batch ]) >= self.maxregions: self.flush(key)
+        return future
+
+    def flush(self, key):
+        batch, timer = self.pending.pop(key)
+        timer.cancel()
+        task = asyncio.ensure_future(self.run(key, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, key, batch):
+        loop = asyncio.get_running_loop()
+        self.batches += 1
+        METRICS.count("server_batches", 1)
+        try:
+            values = await loop.run_in_executor(self.executor, extract, self.pool, key, [ x for items, _ in batch for x in items ])
+        except Exception as e:
+            for _, future in batch: future.set_exception(e)
+            return
+        offsets = numpy.cumsum([ 0 ] + [ len(items) for items, _ in batch ])
+        for i, (_, future) in enumerate(batch):
+            future.set_result(values[offsets[i]:offsets[i + 1]])
+
+    async def answer(self, line, writer, lock):
+        rid = None
+        try:
+            message = ujson.loads(line)
+            if not isinstance(message, dict): raise Exception("Error: requests must be JSON objects.")
+            rid = message.get("id")
+            options, regions, key, items = parse(message)
+            values = await self.submit(key, items)
+            response = { "id": rid, "result": respond(message["command"], options, regions, values) }
+        except Exception as e:
+            response = { "id": rid, "error": str(e) }
+        await self.reply(response, writer, lock)
+
+    async def reply(self, response, writer, lock):
+        async with lock:
+            writer.write((ujson.dumps(response) + '\n').encode())
+            await writer.drain()
+
+    async def readline(self, reader):
+        """
+        Reads a request line, or skips it if it is longer than the server's limit.
+
+        Returns:
+            Tuple of the line, empty at the end of the stream, and whether it was skipped for being too long.
+        """
+        try:
+            return await reader.readuntil(b'\n'), False
+        except asyncio.IncompleteReadError as e:
+            return e.partial, False
+        except asyncio.LimitOverrunError:
+            pass
+        while True:
+            try:
+                await reader.readuntil(b'\n')
+                return b'\n', True
+            except asyncio.IncompleteReadError:
+                return b'', True
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+
+    async def connection(self, reader, writer):
+        lock, tasks = asyncio.Lock(), []
+        try:
+            while True:
+                line, skipped = await self.readline(reader)
+                if skipped:
+                    error = "Error: request is longer than the limit of %d bytes; send fewer regions per request." % self.limit
+                    tasks.append(asyncio.ensure_future(self.reply({ "id": None, "error": error }, writer, lock)))
+                if not line: break
+                if len(line.strip()) == 0: continue
+                tasks.append(asyncio.ensure_future(self.answer(line, writer, lock)))
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, socket: str = None, host: str = "127.0.0.1", port: int = None):
+        """
+        Serves requests on a Unix socket at the given path, or on the given TCP host and port, until stop is called.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.connection, path = socket, limit = self.limit)
+        else:
+            server = await asyncio.start_server(self.connection, host, port, limit = self.limit)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            if socket is not None and os.path.exists(socket): os.remove(socket)
+            self.executor.submit(self.pool.close).result()
+            self.executor.shutdown()
+
+    def stop(self):
+        """
+        Stops the server; may be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+def runserve(args):
+    if args.socket is None and args.port is None:
+        raise Exception("Error: pass --socket or --port to serve requests on.")
+    server = SignalServer(args.batch_window / 1000, args.max_batch_regions, args.max_open_files)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
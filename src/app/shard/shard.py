@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import ujson
+import numpy
+
+from ..matrixfile.matrixfile import MAGIC, MatrixFileReader
+
+PARTIAL = "aggregate-partial"
+
+def writepartial(path: str, names, sums, counts, metadata = None):
+    """
+    Writes a partial aggregate: the summed signal and region count for each group from one shard of a BED file, as from
+    aggregate.streamsums. Unlike averages, partials from any number of shards can be combined exactly.
+
+    Args:
+        path (string): path to write the partial to, in JSON format
+        names (dict): group name (None if not grouped) to row number
+        sums (numpy.ndarray): float64 matrix with the summed signal for each group
+        counts (numpy.ndarray): number of regions summed in each group
+        metadata (dict): settings used to compute the sums, which must match between shards
+    """
+    with open(path, 'w') as o:
+        o.write(ujson.dumps({
+            "format": PARTIAL,
+            "names": sorted(names, key = names.get),
+            "width": sums.shape[1],
+            "sums": sums.tolist(),
+            "counts": counts.tolist(),
+            "metadata": metadata if metadata is not None else {}
+        }) + '\n')
+
+def readpartial(path: str):
+    """
+    Returns:
+        Tuple of the group name to row number dictionary, sums, counts and metadata from a partial written by writepartial.
+    """
+    with open(path, 'r') as f:
+        partial = ujson.loads(f.read())
+    if not isinstance(partial, dict) or partial.get("format") != PARTIAL:
+        raise Exception("Error opening %s: not a partial aggregate." % path)
+    names = { k: i for i, k in enumerate(partial["names"]) }
+    sums = numpy.array(partial["sums"], dtype = numpy.float64).reshape(len(names), partial["width"])
+    return names, sums, numpy.array(partial["counts"], dtype = numpy.int64), partial["metadata"]
+
+def mergepartials(paths):
+    """
+    Combines partial aggregates from a number of shards, reading one at a time. Groups are ordered by their first appearance,
+    taking the shards in the order given.
+
+    Returns:
+        Tuple of the combined group name to row number dictionary, sums, counts and the shared metadata.
+    """
+    names, sums, counts, metadata = {}, None, None, None
+    for path in paths:
+        shardnames, shardsums, shardcounts, shardmetadata = readpartial(path)
+        if metadata is None:
+            metadata, sums, counts = shardmetadata, numpy.zeros((0, shardsums.shape[1])), numpy.zeros(0, dtype = numpy.int64)
+        elif shardmetadata != metadata:
+            raise Exception("Error merging %s: settings %s do not match previous shards %s." % (path, shardmetadata, metadata))
+        for name in shardnames: names.setdefault(name, len(names))
+        sums = numpy.vstack([ sums, numpy.zeros((len(names) - len(sums), sums.shape[1])) ])
+        counts = numpy.append(counts, numpy.zeros(len(names) - len(counts), dtype = numpy.int64))
+        rows = numpy.array([ names[name] for name in shardnames ], dtype = numpy.int64)
+        if len(rows) > 0:
+            sums[rows] += shardsums
+            counts[rows] += shardcounts
+    return names, sums, counts, metadata
+
+def ismatrixfile(path: str) -> bool:
+    """
+    Returns:
+        True if the given path is a binary matrix file, as written by matrix --shard, rather than a partial aggregate.
+    """
+    if not os.path.exists(path):
+        raise Exception("Error opening %s: no such file or directory." % path)
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def shardrows(paths, batchsize = 1000):
+    """
+    Reads the rows of a number of matrix file shards in the order given, batchsize rows at a time, opening one shard at a
+    time. Shards must have been written with the same settings.
+
+    Yields:
+        Tuples of the region coordinates for each row, as tuples of chromosome, start, end, and a float64 matrix of rows.
+    """
+    settings = None
+    for path in paths:
+        with MatrixFileReader(path) as f:
+            shardsettings = { k: v for k, v in f.metadata.items() if k != "shard" }
+            if settings is None: settings = shardsettings
+            if shardsettings != settings:
+                raise Exception("Error merging %s: settings %s do not match previous shards %s." % (path, shardsettings, settings))
+            if f.regions is None:
+                raise Exception("Error merging %s: shard has no region coordinates." % path)
+            for i in range(0, len(f), batchsize):
+                regions = [ tuple(x) for x in f.regions[i : i + batchsize] ]
+                yield regions, f.rowblock(i, len(regions)).astype(numpy.float64)
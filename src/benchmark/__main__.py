@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import ujson
+
+from .fixtures import fixtures
+
+# subcommand, variant name, extra arguments
+CASES = [
+    ("aggregate", "all", []),
+    ("aggregate", "streaming", [ "--streaming" ]),
+    ("matrix", "all", []),
+    ("matrix", "streaming", [ "--streaming" ]),
+    ("matrix", "random-access", [ "--streaming", "--random-access" ]),
+    ("matrix", "binary", [ "--format", "binary" ]),
+    ("sequence", "all", []),
+    ("sequence", "streaming", [ "--streaming" ]),
+    ("zscore", "all", [])
+]
+
+def command(subcommand, extra, paths, args, j, output):
+    """
+    Returns:
+        Command line running the given subcommand of the app on the benchmark fixtures.
+    """
+    cmd = [ sys.executable, "-m", "app", subcommand, "--bed-file", paths["bed_file"], "--output-file", output, "-j", str(j) ]
+    if subcommand == "sequence":
+        cmd += [ "--two-bit-file", paths["two_bit_file"], "--extsize", str(args.extsize) ]
+    else:
+        cmd += [ "--signal-file", paths["signal_file"] ]
+    if subcommand in ("aggregate", "matrix"):
+        cmd += [ "--extsize", str(args.extsize), "--resolution", str(args.resolution) ]
+    return cmd + extra
+
+def measure(cmd, output):
+    """
+    Runs a command in a child process.
+
+    Returns:
+        Dictionary with the wall clock seconds taken, the peak resident set size in bytes of the largest process (the child
+        or any worker process it waited for), the size of the output file and the exit status.
+    """
+    # stderr goes to a file rather than a pipe, which a child writing more than the pipe buffer would block on
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))), stdout = subprocess.DEVNULL, stderr = errors)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        errors.seek(0)
+        stderr = errors.read().decode(errors = "replace")
+    return {
+        "seconds": seconds,
+        "peak_rss_bytes": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "output_bytes": os.path.getsize(output) if os.path.exists(output) else 0,
+        "status": os.waitstatus_to_exitcode(status),
+        "error": stderr.strip().splitlines()[-1] if status != 0 and stderr.strip() else None
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Compares throughput against a previous results file.
+
+    Returns:
+        List of messages describing each case whose regions per second dropped by more than the tolerance fraction.
+    """
+    previous = { (x["subcommand"], x["variant"], x["j"]): x for x in baseline["results"] }
+    regressions = []
+    for x in results:
+        old = previous.get((x["subcommand"], x["variant"], x["j"]))
+        if old is None or old["status"] != 0 or x["status"] != 0: continue
+        if x["regions_per_second"] < old["regions_per_second"] * (1 - tolerance):
+            regressions.append("%s %s -j %d: %.0f regions/s, was %.0f" % (
+                x["subcommand"], x["variant"], x["j"], x["regions_per_second"], old["regions_per_second"]
+            ))
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Measures extraction throughput and memory for each subcommand on synthetic fixtures.")
+    parser.add_argument("--regions", type = int, help = "number of BED regions; default 100000.", default = 100000)
+    parser.add_argument("--extsize", type = int, help = "number of basepairs to expand each region; default 500.", default = 500)
+    parser.add_argument("--resolution", type = int, help = "bin size in basepairs for aggregate and matrix; default 1.", default = 1)
+    parser.add_argument("--chromosomes", type = int, help = "number of synthetic chromosomes; default 4.", default = 4)
+    parser.add_argument("--chromosome-size", type = int, help = "size of each synthetic chromosome in basepairs; default 10000000.", default = 10000000)
+    parser.add_argument("-j", type = str, help = "comma separated numbers of cores to benchmark; default 1,4.", default = "1,4")
+    parser.add_argument("--repeat", type = int, help = "number of times to run each case, keeping the fastest; default 1.", default = 1)
+    parser.add_argument("--subcommands", type = str, help = "comma separated subcommands to benchmark; default all.", default = "aggregate,matrix,sequence,zscore")
+    parser.add_argument("--fixture-directory", type = str, help = "directory in which to generate and reuse fixtures.", default = os.path.join(tempfile.gettempdir(), "signal-extraction-benchmark"))
+    parser.add_argument("--results-file", type = str, help = "path to write results in JSON format; default benchmark.json.", default = "benchmark.json")
+    parser.add_argument("--baseline", type = str, help = "if passed, path to earlier results; exits with an error if any case is slower by more than --tolerance.", default = None)
+    parser.add_argument("--tolerance", type = float, help = "fraction by which throughput may drop relative to --baseline; default 0.2.", default = 0.2)
+    args = parser.parse_args()
+
+    paths = fixtures(args.fixture_directory, args.regions, args.chromosomes, args.chromosome_size)
+    subcommands = args.subcommands.split(',')
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for subcommand, variant, extra in [ x for x in CASES if x[0] in subcommands ]:
+            for j in [ int(x) for x in args.j.split(',') ]:
+                output = os.path.join(d, "output")
+                runs = []
+                for _ in range(args.repeat):
+                    if os.path.exists(output): os.remove(output)
+                    runs.append(measure(command(subcommand, extra, paths, args, j, output), output))
+                result = min(runs, key = lambda x: (x["status"] != 0, x["seconds"]))
+                result.update({
+                    "subcommand": subcommand, "variant": variant, "j": j,
+                    "regions_per_second": args.regions / result["seconds"] if result["status"] == 0 else 0.0
+                })
+                results.append(result)
+                print("%-10s %-14s -j %-3d %10.0f regions/s %8.1f MB peak RSS %12d output bytes%s" % (
+                    subcommand, variant, j, result["regions_per_second"], result["peak_rss_bytes"] / (1 << 20), result["output_bytes"],
+                    "" if result["status"] == 0 else "  FAILED: %s" % result["error"]
+                ), file = sys.stderr)
+
+    settings = { k: getattr(args, k) for k in ("regions", "extsize", "resolution", "chromosomes", "chromosome_size", "repeat") }
+    environment = { "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count() }
+    with open(args.results_file, 'w') as o:
+        o.write(ujson.dumps({ "settings": settings, "environment": environment, "results": results }, indent = 2) + '\n')
+
+    failed = [ x for x in results if x["status"] != 0 ]
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, ujson.loads(f.read()), args.tolerance)
+        for x in regressions: print("regression: %s" % x, file = sys.stderr)
+    return 1 if len(failed) > 0 or len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import numpy
+import pyBigWig
+
+from app.sequence.twobit import SIGNATURE
+
+# 2bit packs T, C, A, G as 0, 1, 2, 3
+PACKED = numpy.array([ 2, 1, 3, 0 ], dtype = numpy.uint8)
+
+def chromosomes(count: int, size: int):
+    """
+    Returns:
+        List of synthetic chromosome names and sizes, as tuples.
+    """
+    return [ ("chr%d" % (i + 1), size) for i in range(count) ]
+
+def writebigwig(path: str, chroms, step = 50, seed = 0):
+    """
+    Writes a BigWig with random signal covering each chromosome in fixed steps of the given number of basepairs. One step
+    in ten has no signal, so reads see gaps as well as values.
+    """
+    random = numpy.random.default_rng(seed)
+    bw = pyBigWig.open(path, 'w')
+    bw.addHeader(chroms, maxZooms = 10)
+    for chrom, size in chroms:
+        starts = numpy.arange(0, size - step + 1, step, dtype = numpy.int64)
+        starts = starts[random.random(len(starts)) >= 0.1]
+        values = random.gamma(1.0, 2.0, len(starts)).astype(numpy.float64)
+        bw.addEntries([ chrom ] * len(starts), starts.tolist(), ends = (starts + step).tolist(), values = values.tolist())
+    bw.close()
+
+def write2bit(path: str, chroms, nblocks = 10, seed = 0):
+    """
+    Writes a 2bit file with random sequence for each chromosome, including nblocks runs of N per chromosome and no masked
+    blocks.
+    """
+    random = numpy.random.default_rng(seed)
+    records = []
+    for chrom, size in chroms:
+        bases = random.integers(0, 4, size, dtype = numpy.uint8)
+        # blocks must not overlap, so that their ends are sorted like their starts; each is clipped to the next block's start
+        starts = numpy.sort(random.choice(size, nblocks, replace = False)).astype(numpy.int64)
+        sizes = numpy.minimum(random.integers(1, 1000, nblocks), numpy.append(starts[1:], size) - starts)
+        starts, sizes = starts.astype(numpy.uint32), sizes.astype(numpy.uint32)
+        padded = numpy.concatenate([ PACKED[bases], numpy.zeros(-size % 4, dtype = numpy.uint8) ]).reshape(-1, 4)
+        packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) | (padded[:, 2] << 2) | padded[:, 3]
+        records.append(
+            struct.pack('<II', size, nblocks) + starts.tobytes() + sizes.tobytes() + struct.pack('<II', 0, 0) + packed.astype(numpy.uint8).tobytes()
+        )
+    offset = 16 + sum(1 + len(chrom) + 4 for chrom, _ in chroms)
+    with open(path, 'wb') as o:
+        o.write(struct.pack('<IIII', SIGNATURE, 0, len(chroms), 0))
+        for (chrom, _), record in zip(chroms, records):
+            o.write(struct.pack('<B', len(chrom)) + chrom.encode() + struct.pack('<I', offset))
+            offset += len(record)
+        for record in records:
+            o.write(record)
+
+def writebed(path: str, chroms, regions: int, width = 200, seed = 0):
+    """
+    Writes a BED file with the given number of regions placed uniformly at random across the chromosomes, in random order,
+    with a random strand in the fourth field.
+    """
+    random = numpy.random.default_rng(seed)
+    sizes = numpy.array([ size for _, size in chroms ], dtype = numpy.int64)
+    indexes = random.integers(0, len(chroms), regions)
+    starts = random.integers(0, numpy.maximum(sizes[indexes] - width, 1))
+    strands = numpy.array([ '+', '-' ])[random.integers(0, 2, regions)]
+    with open(path, 'w') as o:
+        for i in range(0, regions, 100000):
+            o.write(''.join([
+                "%s\t%d\t%d\t%s\n" % (chroms[c][0], s, s + width, strand)
+                for c, s, strand in zip(indexes[i : i + 100000].tolist(), starts[i : i + 100000].tolist(), strands[i : i + 100000].tolist())
+            ]))
+
+def fixtures(directory: str, regions: int, nchromosomes: int, chromosome_size: int):
+    """
+    Generates a BigWig, 2bit and BED file in the given directory, reusing files generated earlier with the same settings.
+
+    Returns:
+        Dictionary with the paths of the signal_file, two_bit_file and bed_file.
+    """
+    chroms = chromosomes(nchromosomes, chromosome_size)
+    prefix = os.path.join(directory, "synthetic.%dx%d" % (nchromosomes, chromosome_size))
+    paths = { "signal_file": prefix + ".bigWig", "two_bit_file": prefix + ".2bit", "bed_file": "%s.%d.bed" % (prefix, regions) }
+    os.makedirs(directory, exist_ok = True)
+    if not os.path.exists(paths["signal_file"]): writebigwig(paths["signal_file"], chroms)
+    if not os.path.exists(paths["two_bit_file"]): write2bit(paths["two_bit_file"], chroms)
+    if not os.path.exists(paths["bed_file"]): writebed(paths["bed_file"], chroms, regions)
+    return paths
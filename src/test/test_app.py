@@ -4,14 +4,41 @@ import os
 import tempfile
 import unittest
 import hashlib
+import gzip
+import glob
+import shutil
+import ujson
+import numpy
+import pyBigWig
+import socket
+import asyncio
+import threading
+import subprocess
+import sys
+import time
+from unittest import mock
 
-from app.app import runaggregate, runmatrix, runsequence, runzscore
+import app.app
+from app.app import runaggregate, runmatrix, runsequence, runzscore, runmerge
+from app.engine import ExtractionEngine
+from app.aggregate import foldgroups
+from app.matrixfile.matrixfile import MatrixFileReader
+from app.bed.bed import BedReader, loadbed
+from app.sequence.twobit import TwoBitReader
+from app.metrics.metrics import METRICS
+from app.cache.cache import MatrixCache
+from app.server.server import SignalServer
+from benchmark.fixtures import fixtures
 
 class TestInput:
     
     def __init__(
         self, testbed = "test.bed", startindex = 0, endindex = None, resolution = 1, decimal_resolution = 2, grouped = False,
-        coordinate_map = False, extsize = 5, streaming = False, random_access = False, json = False
+        coordinate_map = False, extsize = 5, streaming = False, random_access = False, json = False, shared_memory = False,
+        format = "json", dtype = "float32", encoding = "onehot", cache_size = 0, inflight_batches = 2,
+        stat = "sum", approximate = False, shard = False, cache_dir = None, cache_max_size = 10240,
+        signal_manifest = None, stacked = False, resume = False, summary = "bases",
+        intervals = False
     ):
         self.signal_file = os.path.join(os.path.dirname(__file__), "resources", "test.bigWig")
         self.two_bit_file = os.path.join(os.path.dirname(__file__), "resources", "chrTest.2bit")
@@ -28,6 +55,22 @@ class TestInput:
         self.streaming = streaming
         self.random_access = random_access
         self.json = json
+        self.shared_memory = shared_memory
+        self.format = format
+        self.dtype = dtype
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.inflight_batches = inflight_batches
+        self.stat = stat
+        self.approximate = approximate
+        self.shard = shard
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.signal_manifest = signal_manifest
+        self.stacked = stacked
+        self.resume = resume
+        self.summary = summary
+        self.intervals = intervals
 
     def __enter__(self):
         self.output = tempfile.NamedTemporaryFile()
@@ -61,6 +104,35 @@ class TestApp(unittest.TestCase):
             runzscore(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "0e3397fce1282ab6b4ad26955c2264b9")
 
+    def test_runzscore_parallel(self):
+        with TestInput(testbed = "test.chrTest.signal.bed") as test:
+            test.j = 2
+            test.batch_size = 1
+            runzscore(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "a9309e8fa95fb36d6651842f9bc086ea")
+
+    def statscores(self, paths, stat, exact):
+        bw = pyBigWig.open(paths["signal_file"])
+        values = numpy.array([ bw.stats(c, s, e, type = stat, exact = exact)[0] or 0 for c, s, e, _ in loadbed(paths["bed_file"]).regions() ])
+        self.assertTrue((values > 0).all() and values.std() > 0)
+        logs = numpy.log(values)
+        return ((logs - logs.mean()) / logs.std()).tolist()
+
+    def zscorestats(self, approximate):
+        with tempfile.TemporaryDirectory() as d:
+            paths = fixtures(d, 50, 2, 5000)
+            for stat in ("sum", "mean", "max", "coverage"):
+                with TestInput(stat = stat, extsize = None, json = True, approximate = approximate) as test:
+                    test.bed_file, test.signal_file = paths["bed_file"], paths["signal_file"]
+                    runzscore(test)
+                    numpy.testing.assert_allclose(ujson.loads(test.output.read()), self.statscores(paths, stat, not approximate))
+
+    def test_runzscore_approximate(self):
+        self.zscorestats(True)
+
+    def test_runzscore_coverage(self):
+        self.zscorestats(False)
+
     def test_runaggregate_10(self):
         with TestInput(resolution = 2) as test:
             runaggregate(test)
@@ -71,11 +143,95 @@ class TestApp(unittest.TestCase):
             runmatrix(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "b9b14755e8fd0c29342fb417aa0db286")
     
+    def test_runmatrix_shared_memory(self):
+        with TestInput(shared_memory = True) as test:
+            test.j = 2
+            runmatrix(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "b9b14755e8fd0c29342fb417aa0db286")
+
+    def test_runaggregate_shared_memory(self):
+        with TestInput(testbed = "test.offsets.bed", resolution = 2, shared_memory = True) as test:
+            test.j = 2
+            runaggregate(test)
+            shared = hashlib.md5(test.output.read()).hexdigest()
+        with TestInput(testbed = "test.offsets.bed", resolution = 2) as test:
+            runaggregate(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), shared)
+
+    def test_runmatrix_unsorted(self):
+        with TestInput(testbed = "test.unsorted.bed") as test:
+            test.j = 3
+            runmatrix(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "e67fbcad431efb9bf2b5ce7ec45d2881")
+
+    def test_runmatrix_unsorted_shared_memory(self):
+        with TestInput(testbed = "test.unsorted.bed", shared_memory = True) as test:
+            test.j = 3
+            runmatrix(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "e67fbcad431efb9bf2b5ce7ec45d2881")
+
     def test_runmatrix_randomaccess(self):
         with TestInput(random_access = True, streaming = True) as test:
             runmatrix(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "0558c9bd39b771dfb3ff3142e1d03b4b")
 
+    def test_runmatrix_stream_empty_batches(self):
+        for coordinate_map in (False, True):
+            with TestInput(streaming = True, coordinate_map = coordinate_map, startindex = 5) as test:
+                runmatrix(test)
+                self.assertEqual(len(ujson.loads(test.output.read())), 0)
+
+    def test_runmatrix_binary(self):
+        with TestInput(testbed = "test.unsorted.bed", resolution = 2) as test:
+            runmatrix(test)
+            expected = numpy.array(ujson.loads(test.output.read()), dtype = numpy.float32)
+        with TestInput(testbed = "test.unsorted.bed", resolution = 2, format = "binary") as test:
+            runmatrix(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(len(m), 6)
+                self.assertEqual(m.metadata["resolution"], 2)
+                self.assertEqual(m.regions[3], [ "chr1", 9, 19 ])
+                self.assertEqual(m.regions[-1], m.regions[5])
+                self.assertEqual(m.regions[1:6:2], [ m.regions[1], m.regions[3], m.regions[5] ])
+                self.assertEqual(len(m.regions), 6)
+                self.assertEqual(sorted(m.regions.chromosomes), [ "chr1", "chr2" ])
+                numpy.testing.assert_array_equal(m[3], expected[3])
+                numpy.testing.assert_array_equal(m[-1], expected[-1])
+                numpy.testing.assert_array_equal(m[1:5], expected[1:5])
+                numpy.testing.assert_array_equal(m[::-2], expected[::-2])
+                numpy.testing.assert_array_equal(m.array(), expected)
+
+    def test_runmatrix_binary_startindex(self):
+        with TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5) as test:
+            test.batch_size = 2
+            runmatrix(test)
+            expected = numpy.array(ujson.loads(test.output.read()), dtype = numpy.float32)
+        with TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5, format = "binary") as test:
+            test.batch_size = 2
+            runmatrix(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(len(m), 4)
+                self.assertEqual(m.regions[0], [ "chr2", 5, 15 ])
+                numpy.testing.assert_array_equal(m.array(), expected)
+
+    def test_runmatrix_binary_negativeindex(self):
+        with TestInput(testbed = "test.unsorted.bed", startindex = -4, endindex = -1) as test:
+            runmatrix(test)
+            expected = numpy.array(ujson.loads(test.output.read()), dtype = numpy.float32)
+        with TestInput(testbed = "test.unsorted.bed", startindex = -4, endindex = -1, format = "binary") as test:
+            test.batch_size = 2
+            runmatrix(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(len(m), 3)
+                numpy.testing.assert_array_equal(m.array(), expected)
+
+    def test_runmatrix_binary_float16(self):
+        with TestInput(format = "binary", dtype = "float16", streaming = True) as test:
+            runmatrix(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(m.dtype, numpy.float16)
+                self.assertEqual(m.array().tolist(), [ [ 1.0, 1.0, 1.0, 1.0, 1.0, 0.0, 2.0, 2.0, 2.0, 2.0 ] ])
+
     def test_runmatrix_coordinate_map(self):
         with TestInput(coordinate_map = True) as test:
             runmatrix(test)
@@ -89,6 +245,19 @@ class TestApp(unittest.TestCase):
             runmatrix(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), streamed)
         
+    def test_runmatrix_streamed_parallel(self):
+        with TestInput(testbed = "test.unsorted.bed", streaming = True) as test:
+            test.j = 2
+            test.batch_size = 2
+            runmatrix(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "e67fbcad431efb9bf2b5ce7ec45d2881")
+
+    def test_runmatrix_streamed_unpipelined(self):
+        with TestInput(testbed = "test.unsorted.bed", streaming = True, inflight_batches = 0) as test:
+            test.batch_size = 2
+            runmatrix(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "e67fbcad431efb9bf2b5ce7ec45d2881")
+
     def test_runmatrix_coordinate_map_streamed(self):
         with TestInput(coordinate_map = True, streaming = True) as test:
             runmatrix(test)
@@ -117,6 +286,41 @@ class TestApp(unittest.TestCase):
             runaggregate(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "05355371a11e2df119eab0ebadd99dd0")
 
+    def test_runaggregate_streamed(self):
+        with TestInput(testbed = "test.offsets.bed", startindex = 1, streaming = True) as test:
+            test.batch_size = 1
+            runaggregate(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "fd76fa57c7a036b6798a3f6b4ad3a944")
+        for kwargs in [ { "startindex": -2 }, { "endindex": -1 } ]:
+            with TestInput(testbed = "test.offsets.bed", streaming = True, **kwargs) as test:
+                self.assertRaisesRegex(Exception, "negative", runaggregate, test)
+
+    def test_runaggregate_grouped_streamed(self):
+        with TestInput(testbed = "test.group.bed", grouped = True, streaming = True) as test:
+            test.batch_size = 2
+            with mock.patch.object(ExtractionEngine, "sums", autospec = True, side_effect = ExtractionEngine.sums) as sums:
+                runaggregate(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "05355371a11e2df119eab0ebadd99dd0")
+            self.assertGreater(sums.call_count, 1)
+
+    def test_runaggregate_grouped_parallel(self):
+        with TestInput(testbed = "test.group.bed", grouped = True, resolution = 2) as test:
+            runaggregate(test)
+            serial = hashlib.md5(test.output.read()).hexdigest()
+        with TestInput(testbed = "test.group.bed", grouped = True, resolution = 2) as test:
+            test.j = 3
+            runaggregate(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), serial)
+
+    def test_foldgroups(self):
+        matrix = numpy.random.default_rng(0).random((50, 4)).astype(numpy.float32)
+        for groups in [ numpy.zeros(50, dtype = numpy.int64), numpy.arange(50) % 7 * 3, numpy.zeros(0, dtype = numpy.int64) ]:
+            expected = numpy.zeros((int(groups.max(initial = 0)) + 1, 4))
+            numpy.add.at(expected, groups, matrix[:len(groups)])
+            keys, sums = foldgroups(groups, matrix[:len(groups)])
+            self.assertEqual(keys.tolist(), sorted(set(groups.tolist())))
+            numpy.testing.assert_allclose(sums, expected[keys])
+
     def test_runsequence(self):
         with TestInput(testbed = "test.chrTest.bed") as test:
             runsequence(test)
@@ -140,6 +344,48 @@ class TestApp(unittest.TestCase):
             runsequence(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "9f61a1e2234f8980e81d31153319533c")
 
+    def test_runsequence_parallel(self):
+        with TestInput(testbed = "test.chrTest.bed") as test:
+            test.j = 3
+            runsequence(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "6efa138a53b74e9cdf7489367cde7832")
+
+    def test_runsequence_all_cores(self):
+        with TestInput(testbed = "test.chrTest.bed") as test:
+            test.j = -1
+            runsequence(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "6efa138a53b74e9cdf7489367cde7832")
+
+    def test_runsequence_randomaccess_parallel(self):
+        with TestInput(testbed = "test.chrTest.bed", extsize = 7, streaming = True, random_access = True) as test:
+            test.j = 3
+            test.batch_size = 1
+            runsequence(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "9f61a1e2234f8980e81d31153319533c")
+
+    def test_runsequence_cached(self):
+        with TestInput(testbed = "test.chrTest.bed", cache_size = 1) as test:
+            runsequence(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "6efa138a53b74e9cdf7489367cde7832")
+
+    def test_runsequence_binary(self):
+        with TestInput(testbed = "test.chrTest.bed", extsize = 7) as test:
+            runsequence(test)
+            expected = numpy.array(ujson.loads(test.output.read()), dtype = numpy.uint8)
+        with TestInput(testbed = "test.chrTest.bed", extsize = 7, format = "binary") as test:
+            runsequence(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(m.dtype, numpy.uint8)
+                self.assertEqual(m.regions[1], [ "chrTest", 0, 14 ])
+                numpy.testing.assert_array_equal(m.array(), expected)
+
+    def test_runsequence_binary_codes(self):
+        with TestInput(testbed = "test.chrTest.bed", extsize = 7, format = "binary", encoding = "codes") as test:
+            runsequence(test)
+            with MatrixFileReader(test.output_file) as m:
+                self.assertEqual(m[0].tolist(), [ 4, 4, 4, 4, 4, 0, 0, 0, 0, 0, 1, 1, 1, 1 ])
+                self.assertEqual(m[2].tolist(), [ 4 ] * 14)
+
     def test_runsequence_coordinate_map_stream(self):
         with TestInput(testbed = "test.chrTest.bed", coordinate_map = True, extsize = 7, streaming = True) as test:
             runsequence(test)
@@ -147,3 +393,392 @@ class TestApp(unittest.TestCase):
         with TestInput(testbed = "test.chrTest.bed", coordinate_map = True, extsize = 7) as test:
             runsequence(test)
             self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), streamed)
+
+    def test_runzscore_gzip(self):
+        with TestInput(testbed = "test.chrTest.signal.bed") as test, tempfile.NamedTemporaryFile() as compressed:
+            with open(test.bed_file, 'rb') as f, gzip.open(compressed.name, 'wb') as o:
+                shutil.copyfileobj(f, o)
+            test.bed_file = compressed.name
+            runzscore(test)
+            self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "a9309e8fa95fb36d6651842f9bc086ea")
+
+    def test_loadbed_range(self):
+        bed = os.path.join(os.path.dirname(__file__), "resources", "test.unsorted.bed")
+        regions = loadbed(bed)
+        for start, end in [ (0, None), (2, 4), (3, None), (-2, None), (1, -1), (10, None) ]:
+            self.assertEqual(loadbed(bed, start, end).regions(), regions.regions()[start:end])
+        with BedReader(bed, 4, 1) as f:
+            self.assertEqual([ x for batch in f for x in batch.centers() ], regions.centers()[1:])
+        for start, end in [ (-2, None), (1, -1), (-10, -3) ]:
+            with BedReader(bed, 4, start, end) as f:
+                self.assertEqual([ x for batch in f for x in batch.centers() ], regions.centers()[start:end])
+
+    def shards(self, run, ranges, **kwargs):
+        shards = []
+        for start, end in ranges:
+            shards.append(tempfile.NamedTemporaryFile())
+            with TestInput(shard = True, startindex = start, endindex = end, **kwargs) as test:
+                test.output_file = shards[-1].name
+                run(test)
+        return shards
+
+    def test_runmerge_aggregate(self):
+        for kwargs in [ {}, { "testbed": "test.unsorted.bed" }, { "testbed": "test.group.bed", "grouped": True } ]:
+            with TestInput(**kwargs) as test:
+                runaggregate(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            shards = self.shards(runaggregate, [ (0, 2), (2, 3), (3, None) ], **kwargs)
+            with TestInput() as test:
+                test.shards = [ x.name for x in shards ]
+                runmerge(test)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+
+    def test_runmerge_matrix(self):
+        for kwargs in [ {}, { "coordinate_map": True }, { "random_access": True, "streaming": True }, { "format": "binary" } ]:
+            with TestInput(testbed = "test.unsorted.bed", **kwargs) as test:
+                runmatrix(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            shards = self.shards(runmatrix, [ (0, 2), (2, 5), (5, None) ], testbed = "test.unsorted.bed")
+            with TestInput(**kwargs) as test:
+                test.shards = [ x.name for x in shards ]
+                runmerge(test)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+
+    def test_runmerge_matrix_fractional(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = fixtures(d, 20, 2, 5000)
+            for resolution in (1, 2):
+                with TestInput(resolution = resolution) as test:
+                    test.bed_file, test.signal_file = paths["bed_file"], paths["signal_file"]
+                    runmatrix(test)
+                    expected = test.output.read()
+                self.assertTrue((numpy.array(ujson.loads(expected)) % 1 != 0).any())
+                shards = []
+                for start, end in [ (0, 7), (7, None) ]:
+                    shards.append(tempfile.NamedTemporaryFile())
+                    with TestInput(shard = True, startindex = start, endindex = end, resolution = resolution) as test:
+                        test.bed_file, test.signal_file, test.output_file = paths["bed_file"], paths["signal_file"], shards[-1].name
+                        runmatrix(test)
+                with TestInput() as test:
+                    test.shards = [ x.name for x in shards ]
+                    runmerge(test)
+                    self.assertEqual(test.output.read(), expected)
+
+    def test_benchmark_fixtures(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = fixtures(d, 100, 2, 5000)
+            with TestInput() as test:
+                test.bed_file, test.signal_file, test.two_bit_file = paths["bed_file"], paths["signal_file"], paths["two_bit_file"]
+                runmatrix(test)
+                self.assertEqual(numpy.array(ujson.loads(test.output.read())).shape, (100, 10))
+            with TestInput() as test:
+                test.bed_file, test.two_bit_file = paths["bed_file"], paths["two_bit_file"]
+                runsequence(test)
+                self.assertEqual(numpy.array(ujson.loads(test.output.read())).shape, (100, 10, 4))
+            with TwoBitReader(paths["two_bit_file"]) as f:
+                self.assertEqual([ f.record(x)[0] for x in ("chr1", "chr2") ], [ 5000, 5000 ])
+
+    def test_runmatrix_metrics(self):
+        METRICS.enable()
+        try:
+            with TestInput(streaming = True) as test:
+                runmatrix(test)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "b9b14755e8fd0c29342fb417aa0db286")
+            report = METRICS.report()
+        finally:
+            METRICS.disable()
+        self.assertEqual(report["counters"]["rows_written"], report["counters"]["regions_read"])
+        self.assertGreater(report["counters"]["bytes_written"], 0)
+        self.assertTrue(all([ x in report["stages"] for x in ("parse", "read", "encode", "write") ]))
+        self.assertTrue(0 <= report["workers"]["read"]["utilization"] <= 1)
+
+    def test_runmatrix_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            with TestInput(cache_dir = d) as test:
+                runmatrix(test)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "b9b14755e8fd0c29342fb417aa0db286")
+            self.assertEqual(len(os.listdir(d)), 1)
+            with TestInput(resolution = 2) as test:
+                runmatrix(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            METRICS.enable()
+            try:
+                with TestInput(resolution = 2, cache_dir = d) as test:
+                    runmatrix(test)
+                    self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+                with TestInput(cache_dir = d) as test:
+                    runaggregate(test)
+                    self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), "ef3de94cf04e83f8b924aa1275692ef7")
+                report = METRICS.report()
+            finally:
+                METRICS.disable()
+            self.assertGreater(report["counters"]["regions_cached"], 0)
+            self.assertNotIn("read", report["stages"])
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = MatrixCache(d, 6000)
+            cache.put("a", numpy.ones((10, 100)))
+            cache.put("b", numpy.ones((10, 100)) * 2)
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(float(cache.get("b").sum()), 2000.0)
+            cache.put("c", numpy.ones((1, 2000)))
+            self.assertIsNone(cache.get("c"))
+        with tempfile.TemporaryDirectory() as d, mock.patch("glob.glob", wraps = glob.glob) as scan:
+            cache = MatrixCache(d, 6000)
+            for i in range(10):
+                cache.put(str(i), numpy.ones((1, 100)) * i)
+            self.assertEqual(scan.call_count, 1)
+            cache.put("a", numpy.ones((10, 100)))
+            self.assertEqual(scan.call_count, 2)
+            self.assertEqual(sorted(os.listdir(d)), [ "7.npy", "8.npy", "9.npy", "a.npy" ])
+            self.assertIsNone(cache.get("0"))
+            self.assertEqual(float(cache.get("9").sum()), 900.0)
+
+    def tracks(self, test, d):
+        test.signal_manifest = os.path.join(d, "manifest.txt")
+        with open(test.signal_manifest, 'w') as f:
+            f.write("a\t%s\n\nb\t%s\n" % (test.signal_file, test.signal_file))
+        test.signal_file = None
+        test.output_file = os.path.join(d, "{track}.json")
+
+    def test_runaggregate_tracks(self):
+        for kwargs in [ {}, { "testbed": "test.group.bed", "grouped": True } ]:
+            with TestInput(**kwargs) as test:
+                runaggregate(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            with tempfile.TemporaryDirectory() as d, TestInput(**kwargs) as test:
+                self.tracks(test, d)
+                runaggregate(test)
+                for name in ("a", "b"):
+                    with open(os.path.join(d, name + ".json"), 'rb') as f:
+                        self.assertEqual(hashlib.md5(f.read()).hexdigest(), expected)
+                test.stacked, test.output_file = True, os.path.join(d, "stacked.json")
+                runaggregate(test)
+                with open(test.output_file, 'r') as f:
+                    stacked = ujson.loads(f.read())
+                with open(os.path.join(d, "a.json"), 'r') as f:
+                    self.assertEqual(stacked, { "a": ujson.loads(f.read()), "b": stacked["a"] })
+
+    def test_runmatrix_tracks(self):
+        with tempfile.TemporaryDirectory() as d, TestInput() as test:
+            self.tracks(test, d)
+            runmatrix(test)
+            for name in ("a", "b"):
+                with open(os.path.join(d, name + ".json"), 'rb') as f:
+                    self.assertEqual(hashlib.md5(f.read()).hexdigest(), "b9b14755e8fd0c29342fb417aa0db286")
+            test.stacked, test.format, test.output_file = True, "binary", os.path.join(d, "stacked.bin")
+            runmatrix(test)
+            with MatrixFileReader(test.output_file) as m, open(os.path.join(d, "a.json"), 'r') as f:
+                expected = numpy.array(ujson.loads(f.read()), dtype = numpy.float32)
+                self.assertEqual(m.metadata["tracks"], [ "a", "b" ])
+                numpy.testing.assert_array_equal(m.array(), numpy.stack([ expected, expected ], axis = 1))
+        with TestInput() as test:
+            test.signal_file = None
+            self.assertRaises(Exception, runmatrix, test)
+
+    def test_runmatrix_tracks_startindex(self):
+        with TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5) as test:
+            test.batch_size = 2
+            runmatrix(test)
+            expected = hashlib.md5(test.output.read()).hexdigest()
+        with tempfile.TemporaryDirectory() as d, TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5) as test:
+            test.batch_size = 2
+            self.tracks(test, d)
+            runmatrix(test)
+            for name in ("a", "b"):
+                with open(os.path.join(d, name + ".json"), 'rb') as f:
+                    self.assertEqual(hashlib.md5(f.read()).hexdigest(), expected)
+
+    def interrupted(self, target, name, run, test, calls):
+        original = getattr(target, name)
+        def fail(*args, **kwargs):
+            calls[0] -= 1
+            if calls[0] < 0: raise KeyboardInterrupt()
+            return original(*args, **kwargs)
+        with mock.patch.object(target, name, fail):
+            self.assertRaises(KeyboardInterrupt, run, test)
+        self.assertTrue(os.path.exists(test.output_file + ".checkpoint"))
+        with open(test.output_file + (".rows" if test.random_access and test.format == "json" else ""), 'a') as o:
+            o.write("partial")
+
+    def test_resume(self):
+        cases = [
+            (runmatrix, ExtractionEngine, "aggregate", {}), (runmatrix, ExtractionEngine, "aggregate", { "coordinate_map": True }),
+            (runmatrix, ExtractionEngine, "aggregate", { "random_access": True }), (runmatrix, ExtractionEngine, "aggregate", { "format": "binary" }),
+            (runsequence, app.app, "sequences", {}), (runsequence, app.app, "sequences", { "random_access": True }),
+            (runsequence, app.app, "sequences", { "format": "binary" })
+        ]
+        for run, target, name, kwargs in cases:
+            with TestInput(testbed = "test.unsorted.bed", streaming = True, **kwargs) as test:
+                run(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            with TestInput(testbed = "test.unsorted.bed", resume = True, inflight_batches = 0, **kwargs) as test:
+                test.batch_size = 2
+                self.interrupted(target, name, run, test, [ 1 ])
+                self.interrupted(target, name, run, test, [ 1 ])
+                METRICS.enable()
+                try:
+                    run(test)
+                    report = METRICS.report()
+                finally:
+                    METRICS.disable()
+                self.assertEqual(report["counters"]["regions_read"], 2)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+                self.assertFalse(os.path.exists(test.output_file + ".checkpoint"))
+                self.assertFalse(os.path.exists(test.output_file + ".rows"))
+                self.assertFalse(os.path.exists(test.output_file + ".regions"))
+                test.extsize = 6
+                self.interrupted(target, name, run, test, [ 0 ])
+                test.extsize = 5
+                self.assertRaises(Exception, run, test)
+                os.remove(test.output_file + ".checkpoint")
+                if os.path.exists(test.output_file + ".rows"): os.remove(test.output_file + ".rows")
+
+    def test_resume_startindex(self):
+        for kwargs in [ {}, { "format": "binary" } ]:
+            with TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5, **kwargs) as test:
+                test.batch_size = 2
+                runmatrix(test)
+                expected = hashlib.md5(test.output.read()).hexdigest()
+            with TestInput(testbed = "test.unsorted.bed", startindex = 1, endindex = 5, resume = True, inflight_batches = 0, **kwargs) as test:
+                test.batch_size = 2
+                self.interrupted(ExtractionEngine, "aggregate", runmatrix, test, [ 1 ])
+                runmatrix(test)
+                self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+
+    def test_summary(self):
+        for run, kwargs in [ (runmatrix, {}), (runmatrix, { "streaming": True }), (runaggregate, {}), (runaggregate, { "testbed": "test.group.bed", "grouped": True }) ]:
+            for resolution in (1, 2, 3):
+                with TestInput(resolution = resolution, **kwargs) as test:
+                    run(test)
+                    expected = hashlib.md5(test.output.read()).hexdigest()
+                for summary in ("exact", "approximate", "intervals"):
+                    with TestInput(resolution = resolution, summary = summary, **kwargs) as test:
+                        run(test)
+                        self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+
+    def test_runzscore_intervals(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = fixtures(d, 200, 2, 5000)
+            for stat in ("sum", "mean", "max", "coverage"):
+                for extsize in (None, 50):
+                    with TestInput(stat = stat, extsize = extsize) as test:
+                        test.bed_file, test.signal_file = paths["bed_file"], paths["signal_file"]
+                        runzscore(test)
+                        expected = hashlib.md5(test.output.read()).hexdigest()
+                    with TestInput(stat = stat, extsize = extsize, intervals = True) as test:
+                        test.bed_file, test.signal_file = paths["bed_file"], paths["signal_file"]
+                        runzscore(test)
+                        self.assertEqual(hashlib.md5(test.output.read()).hexdigest(), expected)
+
+    def output(self, run, **kwargs):
+        with TestInput(**kwargs) as test:
+            run(test)
+            return ujson.loads(test.output.read())
+
+    def test_serve(self):
+        resources = os.path.join(os.path.dirname(__file__), "resources")
+        def lines(bed):
+            with open(os.path.join(resources, bed), 'r') as f:
+                return [ x for x in f.read().splitlines() if len(x.split()) >= 3 ]
+        signal, twobit = os.path.join(resources, "test.bigWig"), os.path.join(resources, "chrTest.2bit")
+        requests = [
+            { "id": 0, "command": "matrix", "signal_file": signal, "regions": lines("test.bed"), "extsize": 5, "coordinate_map": True },
+            { "id": 1, "command": "aggregate", "signal_file": signal, "regions": lines("test.bed"), "extsize": 5 },
+            { "id": 2, "command": "aggregate", "signal_file": signal, "regions": lines("test.group.bed"), "extsize": 5, "grouped": True },
+            { "id": 3, "command": "sequence", "two_bit_file": twobit, "regions": lines("test.bed"), "extsize": 5 },
+            { "id": 4, "command": "zscore", "signal_file": signal, "regions": lines("test.chrTest.signal.bed"), "extsize": 5 },
+            { "id": 5, "command": "matrix", "regions": lines("test.bed") }
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "server.sock")
+            server = SignalServer(window = 0.2, maxopen = 1)
+            thread = threading.Thread(target = asyncio.run, args = (server.serve(path),))
+            thread.start()
+            try:
+                while not os.path.exists(path): time.sleep(0.01)
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(path)
+                    client.sendall("".join([ ujson.dumps(x) + '\n' for x in requests ]).encode())
+                    client.shutdown(socket.SHUT_WR)
+                    with client.makefile('r') as f:
+                        responses = { x["id"]: x for x in map(ujson.loads, f) }
+            finally:
+                server.stop()
+                thread.join()
+        self.assertEqual(responses[0]["result"], self.output(runmatrix, coordinate_map = True))
+        self.assertEqual(responses[1]["result"], self.output(runaggregate))
+        self.assertEqual(responses[2]["result"], self.output(runaggregate, testbed = "test.group.bed", grouped = True))
+        self.assertEqual(responses[3]["result"], self.output(runsequence))
+        self.assertEqual(responses[4]["result"], self.output(runzscore, testbed = "test.chrTest.signal.bed", json = True))
+        self.assertIn("signal_file", responses[5]["error"])
+        self.assertEqual(server.batches, 3)
+        self.assertFalse(os.path.exists(path))
+
+    def test_serve_long_requests(self):
+        signal = os.path.join(os.path.dirname(__file__), "resources", "test.bigWig")
+        regions = [ "chr1\t%d\t%d\tregion%d" % (i % 20, i % 20, i) for i in range(5000) ]
+        requests = [
+            { "id": 0, "command": "matrix", "signal_file": signal, "regions": regions, "extsize": 5 },
+            { "id": 1, "command": "matrix", "signal_file": signal, "regions": regions * 40, "extsize": 5 },
+            { "id": 2, "command": "aggregate", "signal_file": signal, "regions": regions[:3], "extsize": 5 }
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "server.sock")
+            server = SignalServer(maxregions = 5000)
+            thread = threading.Thread(target = asyncio.run, args = (server.serve(path),))
+            thread.start()
+            try:
+                while not os.path.exists(path): time.sleep(0.01)
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(path)
+                    client.sendall("".join([ ujson.dumps(x) + '\n' for x in requests ]).encode())
+                    client.shutdown(socket.SHUT_WR)
+                    with client.makefile('r') as f:
+                        responses = [ ujson.loads(x) for x in f ]
+            finally:
+                server.stop()
+                thread.join()
+        results = { x["id"]: x for x in responses if x["id"] is not None }
+        self.assertEqual(len(results[0]["result"]), 5000)
+        self.assertEqual(len(results[2]["result"]), 10)
+        self.assertEqual(len(responses), 3)
+        self.assertIn("longer than the limit", [ x for x in responses if x["id"] is None ][0]["error"])
+
+    def test_startup(self):
+        src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        resource = lambda x: os.path.join(src, "test", "resources", x)
+        def startup(*args):
+            # modules imported by a run of the CLI, and the best of three measurements of the time spent importing them
+            runs = []
+            for _ in range(3):
+                stderr = subprocess.run([ sys.executable, "-X", "importtime" ] + list(args), cwd = src, capture_output = True, text = True, check = True).stderr
+                runs.append([ x[len("import time:"):].split("|") for x in stderr.splitlines() if x.startswith("import time:") and "self [us]" not in x ])
+            return { x[2].strip() for x in runs[0] }, min([ sum([ int(x[0]) for x in run ]) for run in runs ]) / 1e6
+        with tempfile.TemporaryDirectory() as d:
+            output = lambda x: os.path.join(d, x)
+            bed = [ "--bed-file", resource("test.bed"), "--extsize", "5", "-j", "1" ]
+            runs = {
+                "none": startup("-m", "app", "--help"),
+                "aggregate": startup("-m", "app", "aggregate", *bed, "--signal-file", resource("test.bigWig"), "--output-file", output("aggregate.json")),
+                "matrix": startup(
+                    "-m", "app", "matrix", *bed, "--signal-file", resource("test.bigWig"), "--output-file", output("shard.bin"), "--shard"
+                ),
+                "sequence": startup("-m", "app", "sequence", *bed, "--two-bit-file", resource("chrTest.2bit"), "--output-file", output("sequence.json")),
+                "zscore": startup(
+                    "-m", "app", "zscore", "--bed-file", resource("test.chrTest.signal.bed"), "--signal-file", resource("test.bigWig"),
+                    "--output-file", output("zscore.json"), "-j", "1"
+                ),
+                "merge": startup("-m", "app", "merge", output("shard.bin"), "--output-file", output("merged.json")),
+                "eager": startup("-c", "import app.__main__, app.app, app.aggregate, app.engine, app.server.server")
+            }
+        heavy = { "numpy", "joblib", "pyBigWig", "asyncio", "app.aggregate", "app.engine", "app.server.server" }
+        loaded = { k: v & heavy for k, (v, _) in runs.items() }
+        self.assertEqual(loaded["none"], set())
+        self.assertEqual(loaded["merge"], { "numpy" })
+        self.assertNotIn("pyBigWig", loaded["sequence"])
+        for name in ("aggregate", "matrix", "sequence", "zscore", "merge"):
+            self.assertNotIn("app.server.server", loaded[name])
+        self.assertLess(runs["none"][1], runs["eager"][1], { k: v for k, (_, v) in runs.items() })
+        self.assertLess(runs["merge"][1], runs["eager"][1], { k: v for k, (_, v) in runs.items() })